@@ -0,0 +1,226 @@
+"""
+artifacts.py - local cache of downloaded files and derived fields
+
+Artifacts are stored by content: each file is kept once under
+``blobs/<sha256 of its bytes>``, however many keys point to it. A small
+SQLite index maps keys to blobs. A key is a hash of what was asked for, e.g.
+the URL path of a GRIB file and one of its messages (so product, date, cycle,
+member, lead and variable), or the digest of an input file, the parameters
+and the digest of the source code of a field derived from it. Each index entry also keeps the HTTP validators
+(ETag, Last-Modified) of a download, so the download can be revalidated with a
+conditional request, and the time the key was last used. When the blobs
+exceed the size limit, the least recently used keys are dropped until they
+fit again, and blobs no key refers to are deleted.
+
+Several processes and threads can share one cache: the index serialises
+updates, blobs are written beside their final name and renamed, and a blob
+evicted under a reader counts as a miss.
+"""
+import os
+import json
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from functools import lru_cache
+
+# ------------------------
+# Config
+# ------------------------
+ARTIFACT_CACHE_DIR = Path(os.getenv("ARTIFACT_CACHE_DIR", ".cache/artifacts"))
+ARTIFACT_CACHE_MB = float(os.getenv("ARTIFACT_CACHE_MB", "1024"))  # 0 disables the cache
+TIMEOUT = 60  # seconds to wait for another process's index update
+
+
+def artifact_key(kind, **parts):
+    """Key of an artifact of ``kind`` ("grib", "field", ...) identified by ``parts`` (JSON-serialisable)."""
+    return hashlib.sha256(json.dumps([kind, parts], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path):
+    """sha256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _source_file_digest(path):
+    return file_digest(path)
+
+
+def source_digest(*modules):
+    """
+    Digest of the source files of ``modules``, for the key of an artifact that
+    their code computes: editing any of them changes the key, so results of
+    older code are not read back.
+    """
+    return hashlib.sha256("".join(_source_file_digest(m.__file__) for m in modules).encode()).hexdigest()
+
+
+class ArtifactCache:
+    """
+    Size-bounded, content-addressed file cache in ``root``, holding at most
+    ``max_bytes`` of blobs (least recently used keys are evicted first).
+    """
+
+    def __init__(self, root=ARTIFACT_CACHE_DIR, max_bytes=ARTIFACT_CACHE_MB*1e6):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+                con = sqlite3.connect(self.root / "index.sqlite", timeout=TIMEOUT, isolation_level=None)
+                con.execute("CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, blob TEXT NOT NULL, "
+                            "size INTEGER NOT NULL, etag TEXT, last_modified TEXT, used REAL NOT NULL)")
+                con.close()
+                self._ready = True
+        return sqlite3.connect(self.root / "index.sqlite", timeout=TIMEOUT, isolation_level=None)
+
+    def blob_path(self, blob):
+        return self.root / "blobs" / blob[:2] / blob
+
+    def get(self, key):
+        """
+        The entry for ``key`` as a dict (path, blob, size, etag, last_modified),
+        marking it as used now, or None on a miss.
+        """
+        con = self._connect()
+        try:
+            row = con.execute("SELECT blob, size, etag, last_modified FROM artifacts WHERE key = ?",
+                              (key,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE artifacts SET used = ? WHERE key = ?", (time.time(), key))
+        finally:
+            con.close()
+        blob, size, etag, last_modified = row
+        path = self.blob_path(blob)
+        if not path.exists():
+            return None
+        return {"path": path, "blob": blob, "size": size, "etag": etag, "last_modified": last_modified}
+
+    def _store(self, key, blob, write, etag=None, last_modified=None):
+        path = self.blob_path(blob)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{blob}.{os.getpid()}.{threading.get_ident()}.tmp")
+            write(tmp)
+            tmp.replace(path)
+        con = self._connect()
+        try:
+            con.execute("INSERT INTO artifacts (key, blob, size, etag, last_modified, used) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET blob = excluded.blob, size = excluded.size, "
+                        "etag = excluded.etag, last_modified = excluded.last_modified, used = excluded.used",
+                        (key, blob, path.stat().st_size, etag, last_modified, time.time()))
+        finally:
+            con.close()
+        self.evict()
+        return path
+
+    def put(self, key, src, etag=None, last_modified=None):
+        """Store the file ``src`` under ``key`` (replacing any earlier entry) and evict if over the limit."""
+        return self._store(key, file_digest(src), lambda tmp: shutil.copyfile(src, tmp), etag, last_modified)
+
+    def put_bytes(self, key, data, etag=None, last_modified=None):
+        """Store ``data`` under ``key``, like ``put``."""
+        return self._store(key, hashlib.sha256(data).hexdigest(), lambda tmp: tmp.write_bytes(data),
+                           etag, last_modified)
+
+    def read_bytes(self, key):
+        """Contents stored under ``key`` (marking it as used), or None on a miss."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            return entry["path"].read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def touch(self, key, etag=None, last_modified=None):
+        """Mark ``key`` as used now and revalidated, keeping validators the server did not resend."""
+        con = self._connect()
+        try:
+            con.execute("UPDATE artifacts SET used = ?, etag = COALESCE(?, etag), "
+                        "last_modified = COALESCE(?, last_modified) WHERE key = ?",
+                        (time.time(), etag, last_modified, key))
+        finally:
+            con.close()
+
+    def evict(self):
+        """Drop least recently used keys until the blobs fit in ``max_bytes``; delete unreferenced blobs."""
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                total = con.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                    "(SELECT DISTINCT blob, size FROM artifacts)").fetchone()[0]
+                dropped = []
+                for key, blob, size in con.execute("SELECT key, blob, size FROM artifacts ORDER BY used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    con.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                    if con.execute("SELECT 1 FROM artifacts WHERE blob = ?", (blob,)).fetchone() is None:
+                        total -= size
+                        dropped.append(blob)
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        finally:
+            con.close()
+        for blob in dropped:
+            self.blob_path(blob).unlink(missing_ok=True)
+
+    def materialise(self, entry, path):
+        """
+        Put the blob of ``entry`` at ``path`` (a hard link where possible, else a
+        copy). Returns False if the blob has been evicted meanwhile.
+        """
+        path = Path(path)
+        path.unlink(missing_ok=True)
+        try:
+            os.link(entry["path"], path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(entry["path"], path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def derived(self, kind, compute, code, **parts):
+        """
+        The result of ``compute()``, cached under (``kind``, ``code``, ``parts``):
+        ``code`` is the ``source_digest`` of the modules whose code computes the
+        result, and ``parts`` should name everything else it depends on, e.g. the
+        ``file_digest`` of the input file and the parameters. Results are
+        pickled, so this is for objects that this code base wrote itself.
+        """
+        if not self.enabled:
+            return compute()
+        key = artifact_key(kind, code=code, **parts)
+        data = self.read_bytes(key)
+        if data is not None:
+            return pickle.loads(data)
+        result = compute()
+        self.put_bytes(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        return result
+
+
+# the cache shared by the scripts
+ARTIFACTS = ArtifactCache()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+backfill.py - run the daily GDAS detectors over past dates
+
+    python scripts/backfill.py 20240101 20241231 --cycles 00 12 --workers 8
+
+Every (date, cycle) is a job: fetch the GDAS analysis (by default from the NOAA
+Open Data archive, as NOMADS only keeps about ten days), decode it once and
+run the rainbelt, heat-low, CAB and convergence detectors on it, in a process
+pool so downloads and detection of different dates overlap. Tiles are not
+written. A job's history rows go to a small JSON checkpoint under
+CHECKPOINT_DIR as soon as it finishes, and jobs with a checkpoint are skipped,
+so an interrupted or partly failed backfill picks up where it stopped when
+run again. When the jobs are done (or the run is interrupted) the rows of all
+checkpoints in the range are upserted into the history database, one
+transaction per product and cycle, and the history CSVs are exported once.
+"""
+import os
+import sys
+import json
+import argparse
+import datetime as dt
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import process_cab
+import process_convergence
+import process_heat_lows
+import process_rainbelt
+from history import export_csv, upsert
+from process_gdas import CYCLE, ingest
+
+# ------------------------
+# Config
+# ------------------------
+CHECKPOINT_DIR = Path(os.getenv("BACKFILL_DIR", ".cache/backfill"))
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", os.cpu_count() or 1))
+
+
+def _rainbelt(fields, masks, date):
+    return process_rainbelt.detect(fields["q"], masks, date)[1]
+
+
+def _heatlow(fields, masks, date):
+    return process_heat_lows.detect(fields["t"], masks, date)[1]
+
+
+def _cab(fields, masks, date):
+    return process_cab.detect(fields["sh2"], masks, date)[1]
+
+
+def _convergence(fields, masks, date):
+    return process_convergence.detect(fields["u"], fields["v"], masks, date)[1]
+
+
+# history product -> its detector's history row for one cycle
+DETECTORS = {"rainbelt": _rainbelt, "heatlow": _heatlow, "cab": _cab, "convergence": _convergence}
+
+
+def checkpoint_path(date, cycle):
+    return CHECKPOINT_DIR / f"{date}{cycle}.json"
+
+
+def dates(start, end):
+    """YYYYMMDD strings from ``start`` to ``end`` inclusive."""
+    day = dt.datetime.strptime(start, "%Y%m%d")
+    last = dt.datetime.strptime(end, "%Y%m%d")
+    while day <= last:
+        yield day.strftime("%Y%m%d")
+        day += dt.timedelta(days=1)
+
+
+def process_date(date, cycle, archive=True):
+    """
+    Fetch and analyse one GDAS cycle and checkpoint its history rows. A detector
+    that finds nothing (no rainbelt polygon, no heat low) leaves its product out.
+    Returns (date, cycle, {product: row}).
+    """
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    grib_path = CHECKPOINT_DIR / f"gdas.{date}.t{cycle}z.pgrb2.0p25.f000"
+    try:
+        fields, masks = ingest(date, cycle, archive=archive, grib_path=grib_path)
+        rows = {}
+        for product, detect in DETECTORS.items():
+            try:
+                row = detect(fields, masks, date)
+            except SystemExit as err:
+                print(f"{date}{cycle} {product}: {err}", file=sys.stderr)
+                continue
+            if row is not None:
+                rows[product] = row
+    finally:
+        # the GRIB file and cfgrib's index files beside it
+        for path in CHECKPOINT_DIR.glob(grib_path.name + "*"):
+            path.unlink(missing_ok=True)
+    path = checkpoint_path(date, cycle)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"date": date, "cycle": cycle, "rows": rows}, f)
+    os.replace(tmp_path, path)
+    return date, cycle, rows
+
+
+def feed_history(jobs):
+    """
+    Upsert the checkpointed rows of ``jobs`` ((date, cycle) pairs) into the history
+    database in bulk and export the history CSVs of the products that changed.
+    Returns the number of rows written.
+    """
+    batches = {}
+    for date, cycle in jobs:
+        path = checkpoint_path(date, cycle)
+        if not path.exists():
+            continue
+        with open(path) as f:
+            rows = json.load(f)["rows"]
+        for product, row in rows.items():
+            batches.setdefault((product, cycle), []).append(row)
+    for (product, cycle), rows in batches.items():
+        upsert(product, rows, cycle)
+    for product in sorted({product for product, _ in batches}):
+        print(f"Updated {export_csv(product)}")
+    return sum(len(rows) for rows in batches.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the GDAS detectors over a range of past dates")
+    parser.add_argument("start", help="first date, YYYYMMDD")
+    parser.add_argument("end", help="last date, YYYYMMDD")
+    parser.add_argument("--cycles", nargs="+", default=[CYCLE], help="cycles to process, e.g. 00 12")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="worker processes")
+    parser.add_argument("--nomads", action="store_true", help="fetch from NOMADS instead of the archive")
+    args = parser.parse_args()
+
+    jobs = [(date, cycle) for date in dates(args.start, args.end) for cycle in args.cycles]
+    todo = [job for job in jobs if not checkpoint_path(*job).exists()]
+    print(f"{len(jobs)} cycles in range, {len(jobs) - len(todo)} already checkpointed, "
+          f"{len(todo)} to process with {args.workers} worker process(es)")
+
+    failed = []
+    pool = ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {pool.submit(process_date, date, cycle, not args.nomads): (date, cycle) for date, cycle in todo}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            date, cycle = futures[fut]
+            try:
+                fut.result()
+            except Exception as err:
+                failed.append((date, cycle))
+                print(f"ERROR: {date}{cycle} failed: {err!r}", file=sys.stderr)
+                continue
+            print(f"[{done}/{len(todo)}] {date}{cycle} done")
+    finally:
+        pool.shutdown(cancel_futures=True)
+        # whatever finished, including jobs checkpointed by earlier runs, goes into the history
+        print(f"Wrote {feed_history(jobs)} history rows")
+
+    if failed:
+        print(f"{len(failed)} cycle(s) failed and will be retried by the next run: "
+              + " ".join(f"{date}{cycle}" for date, cycle in failed), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
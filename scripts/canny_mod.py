@@ -10,6 +10,8 @@ All rights reserved.
 Original author: Lee Kamentsky
 """
 
+from functools import lru_cache
+
 import numpy as np
 import scipy.ndimage as ndi
 from scipy.ndimage import generate_binary_structure, binary_erosion, label
@@ -27,6 +29,105 @@ def assert_nD(arr, ndims):
         raise ValueError(f"Expected array with ndim in {ndims}, got {arr.ndim}")
 
 
+def planar_structure(structure, ndim):
+    """Embed a 2D structuring element in ``ndim`` dimensions so that only the
+    trailing two (spatial) axes are connected; slices of a stack stay separate."""
+    if ndim == 2:
+        return structure
+    out = np.zeros((3,)*(ndim - 2) + structure.shape, bool)
+    out[(1,)*(ndim - 2)] = structure
+    return out
+
+
+def spatial_sobel(image, axis):
+    """``ndi.sobel`` along ``axis``, smoothing only along the other spatial axis
+    (``ndi.sobel`` smooths along every other axis, which would mix slices of a stack)."""
+    axis = axis % image.ndim
+    other = image.ndim - 1 if axis == image.ndim - 2 else image.ndim - 2
+    output = ndi.correlate1d(image, [-1, 0, 1], axis)
+    return ndi.correlate1d(output, [1, 2, 1], other)
+
+
+# boundary handling of the fused gradients; closest to the original near the array edges
+GRADIENT_MODE = "reflect"
+
+
+@lru_cache(maxsize=None)
+def gradient_kernels(sigma, dtype=np.float64, truncate=4.0):
+    """
+    Separable 1D kernels (for ``ndi.correlate1d``) that smooth with a Gaussian of
+    width ``sigma`` and then apply the Sobel operator: ``deriv`` is the Gaussian
+    convolved with the Sobel difference [-1, 0, 1], ``smooth`` with the Sobel
+    smoothing [1, 2, 1]. Cached per (sigma, dtype).
+    """
+    radius = int(truncate*float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    gauss = np.exp(-0.5/float(sigma)**2*x**2) if sigma > 0 else np.ones(1)
+    gauss /= gauss.sum()
+    deriv = np.zeros(2*radius + 3)
+    deriv[2:] += gauss
+    deriv[:-2] -= gauss
+    smooth = np.zeros(2*radius + 3)
+    smooth[:-2] += gauss
+    smooth[1:-1] += 2*gauss
+    smooth[2:] += gauss
+    return deriv.astype(dtype), smooth.astype(dtype)
+
+
+def gaussian_gradients(image, sigma, dx=1, dy=1, mode=GRADIENT_MODE, dtype=np.float64):
+    """
+    Sobel gradients of the Gaussian-smoothed ``image`` along its two trailing axes,
+    each from two separable derivative-of-Gaussian passes. Returns (isobel, jsobel)
+    (y and x gradients) divided by ``dy`` and ``dx``.
+    Away from the array edges this equals smoothing with ``gaussian(mode='constant')``
+    and then ``spatial_sobel``, up to rounding; within ``int(4*sigma+0.5)+1`` cells of
+    an edge the boundary handling differs. Computed in ``dtype`` (float64 or float32).
+    """
+    image = np.asarray(image, dtype=dtype)
+    deriv, smooth = gradient_kernels(float(sigma), image.dtype)
+    along_y = ndi.correlate1d(image, smooth, axis=-2, mode=mode)
+    jsobel = ndi.correlate1d(along_y, deriv, axis=-1, mode=mode)
+    ndi.correlate1d(image, deriv, axis=-2, mode=mode, output=along_y)
+    isobel = ndi.correlate1d(along_y, smooth, axis=-1, mode=mode)
+    jsobel /= dx
+    isobel /= dy
+    return isobel, jsobel
+
+
+# compact encodings of canny's angle output (radians in -pi..pi, NO_EDGE where there is no edge)
+NO_EDGE = -999
+ANGLE_ENCODINGS = ("float", "float16", "int8")
+INT8_NO_EDGE = -128
+INT8_SCALE = 127/np.pi  # steps of ~0.025 rad
+
+
+def encode_angles(points, encoding="float"):
+    """
+    Store an angle array from ``canny`` compactly: "float" leaves it unchanged,
+    "float16" halves a float32 array (NO_EDGE is exact in float16), and "int8"
+    quantises angles to 255 levels over -pi..pi with INT8_NO_EDGE for no edge.
+    """
+    if encoding == "float":
+        return points
+    if encoding == "float16":
+        return points.astype(np.float16)
+    if encoding == "int8":
+        edge = points != NO_EDGE
+        out = np.full(points.shape, INT8_NO_EDGE, np.int8)
+        out[edge] = np.round(points[edge]*INT8_SCALE).astype(np.int8)
+        return out
+    raise ValueError(f"encoding must be one of {ANGLE_ENCODINGS}, got {encoding!r}")
+
+
+def decode_angles(points):
+    """Inverse of ``encode_angles``: float32 radians, NO_EDGE where there is no edge."""
+    if points.dtype == np.int8:
+        out = points.astype(np.float32)/np.float32(INT8_SCALE)
+        out[points == INT8_NO_EDGE] = NO_EDGE
+        return out
+    return points.astype(np.float32, copy=False)
+
+
 def smooth_with_function_and_mask(image, function, mask):
     """Smooth an image with a linear function, ignoring masked pixels
     Parameters
@@ -54,13 +155,139 @@ def smooth_with_function_and_mask(image, function, mask):
     output_image = smoothed_image / (bleed_over + np.finfo(float).eps)
     return output_image
 
+def canny_maxima(image, sigma=1., mask=None, dx=1, dy=1, dtype=np.float64):
+    """
+    The threshold-independent stage of ``canny``: smoothing, gradients and
+    non-maximum suppression. Takes ``canny``'s image, sigma, mask, dx, dy and
+    dtype, and returns ``(theta, magnitude, local_maxima)``: the edge angle and
+    gradient magnitude everywhere, and True at the thinned edge candidates.
+    ``canny`` thresholds this; running it once lets any number of thresholds,
+    angle windows and length filters share it (see ``drylines.edge_sweep``).
+    """
+    assert_nD(image, (2, 3))
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float32, np.float64)
+    if mask is None:
+        # no mask to renormalise for: fused derivative-of-Gaussian gradients
+        isobel, jsobel = gaussian_gradients(img_as_float(image), sigma, dx=dx, dy=dy, dtype=dtype)
+    else:
+        mask = np.broadcast_to(mask, image.shape)
+        # no smoothing across the stack axis
+        sigmas = (0,)*(image.ndim - 2) + (sigma, sigma)
+
+        def fsmooth(x):
+            return img_as_float(gaussian(x, sigmas, mode='constant'))
+
+        smoothed = smooth_with_function_and_mask(image, fsmooth, mask).astype(dtype, copy=False)
+#        jsobel = ndi.sobel(smoothed, axis=1)     #EH CHANGE
+        jsobel = (spatial_sobel(smoothed, axis=-1)/dx).astype(dtype, copy=False)
+#        isobel = ndi.sobel(smoothed, axis=0)     #EH CHANGE
+        isobel = (spatial_sobel(smoothed, axis=-2)/dy).astype(dtype, copy=False)
+    # angle and magnitude written straight into their output arrays
+    theta = np.empty(isobel.shape, dtype)
+    np.negative(isobel, out=theta)
+    np.arctan2(jsobel, theta, out=theta)       #EH ADD
+    abs_isobel = np.abs(isobel)
+    abs_jsobel = np.abs(jsobel)
+    magnitude = np.empty(isobel.shape, dtype)
+    np.hypot(isobel, jsobel, out=magnitude)
+
+    #
+    # Make the eroded mask. Setting the border value to zero will wipe
+    # out the image edges for us.
+    #
+    if mask is None:
+        eroded_mask = np.zeros(image.shape, bool)
+        eroded_mask[..., 1:-1, 1:-1] = True
+    else:
+        s = planar_structure(generate_binary_structure(2, 2), image.ndim)
+        eroded_mask = binary_erosion(mask, s, border_value=0)
+    eroded_mask = eroded_mask & (magnitude > 0)
+    #
+    #--------- Find local maxima --------------
+    #
+    # Assign each point to have a normal of 0-45 degrees, 45-90 degrees,
+    # 90-135 degrees and 135-180 degrees.
+    #
+    local_maxima = np.zeros(image.shape, bool)
+    #----- 0 to 45 degrees ------
+    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
+    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
+    pts = pts_plus | pts_minus
+    pts = eroded_mask & pts
+    # Get the magnitudes shifted left to make a matrix of the points to the
+    # right of pts. Similarly, shift left and down to get the points to the
+    # top right of pts.
+    c1 = magnitude[..., 1:, :][pts[..., :-1, :]]
+    c2 = magnitude[..., 1:, 1:][pts[..., :-1, :-1]]
+    m = magnitude[pts]
+    w = abs_jsobel[pts] / abs_isobel[pts]
+    c_plus = c2 * w + c1 * (1 - w) <= m
+    c1 = magnitude[..., :-1, :][pts[..., 1:, :]]
+    c2 = magnitude[..., :-1, :-1][pts[..., 1:, 1:]]
+    c_minus = c2 * w + c1 * (1 - w) <= m
+    local_maxima[pts] = c_plus & c_minus
+    #----- 45 to 90 degrees ------
+    # Mix diagonal and vertical
+    #
+    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
+    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
+    pts = pts_plus | pts_minus
+    pts = eroded_mask & pts
+    c1 = magnitude[..., :, 1:][pts[..., :, :-1]]
+    c2 = magnitude[..., 1:, 1:][pts[..., :-1, :-1]]
+    m = magnitude[pts]
+    w = abs_isobel[pts] / abs_jsobel[pts]
+    c_plus = c2 * w + c1 * (1 - w) <= m
+    c1 = magnitude[..., :, :-1][pts[..., :, 1:]]
+    c2 = magnitude[..., :-1, :-1][pts[..., 1:, 1:]]
+    c_minus = c2 * w + c1 * (1 - w) <= m
+    local_maxima[pts] = c_plus & c_minus
+    #----- 90 to 135 degrees ------
+    # Mix anti-diagonal and vertical
+    #
+    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
+    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
+    pts = pts_plus | pts_minus
+    pts = eroded_mask & pts
+    c1a = magnitude[..., :, 1:][pts[..., :, :-1]]
+    c2a = magnitude[..., :-1, 1:][pts[..., 1:, :-1]]
+    m = magnitude[pts]
+    w = abs_isobel[pts] / abs_jsobel[pts]
+    c_plus = c2a * w + c1a * (1.0 - w) <= m
+    c1 = magnitude[..., :, :-1][pts[..., :, 1:]]
+    c2 = magnitude[..., 1:, :-1][pts[..., :-1, 1:]]
+    c_minus = c2 * w + c1 * (1.0 - w) <= m
+    local_maxima[pts] = c_plus & c_minus
+    #----- 135 to 180 degrees ------
+    # Mix anti-diagonal and anti-horizontal
+    #
+    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
+    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
+    pts = pts_plus | pts_minus
+    pts = eroded_mask & pts
+    c1 = magnitude[..., :-1, :][pts[..., 1:, :]]
+    c2 = magnitude[..., :-1, 1:][pts[..., 1:, :-1]]
+    m = magnitude[pts]
+    w = abs_jsobel[pts] / abs_isobel[pts]
+    c_plus = c2 * w + c1 * (1 - w) <= m
+    c1 = magnitude[..., 1:, :][pts[..., :-1, :]]
+    c2 = magnitude[..., 1:, :-1][pts[..., :-1, 1:]]
+    c_minus = c2 * w + c1 * (1 - w) <= m
+    local_maxima[pts] = c_plus & c_minus
+
+    return theta, magnitude, local_maxima
+
 def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
-          use_quantiles=False,dx=1,dy=1):
+          use_quantiles=False,dx=1,dy=1,dtype=np.float64,angles="float"):
     """Edge filter an image using the Canny algorithm.
     Parameters
     -----------
-    image : 2D array
+    image : 2D or 3D array
         Grayscale input image to detect edges on; can be of any dtype.
+        A 3D array is a stack of images (time or ensemble, y, x) that are
+        processed together but independently: smoothing, gradients and
+        edge linking act on the two trailing axes only.
     sigma : float
         Standard deviation of the Gaussian filter.
     low_threshold : float
@@ -70,14 +297,24 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
         Upper bound for hysteresis thresholding (linking edges).
         If None, high_threshold is set to 20% of dtype's max.
     mask : array, dtype=bool, optional
-        Mask to limit the application of Canny to a certain area.
+        Mask to limit the application of Canny to a certain area. A 2D mask
+        applies to every image of a stack.
     use_quantiles : bool, optional
         If True then treat low_threshold and high_threshold as quantiles of the
         edge magnitude image, rather than absolute edge magnitude values. If True
         then the thresholds must be in the range [0, 1].
+    dx, dy : float or 2D array
+        Grid spacing the x and y gradients are divided by.
+    dtype : np.float64 or np.float32
+        Precision of smoothing, gradients and non-maximum suppression.
+        float32 halves memory traffic for fields that are float32 anyway
+        (e.g. GRIB specific humidity); edges can differ from float64 at
+        near-ties.
+    angles : "float", "float16" or "int8"
+        Encoding of the returned angles; see ``encode_angles``.
     Returns
     -------
-    output : 2D array (image)
+    output : 2D or 3D array (image)
         The masked edge map. Values are edge angles (this has changed from the original)
     See also
     --------
@@ -158,7 +395,10 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
     #
     ##########################################################
 
-    assert_nD(image, 2)
+    assert_nD(image, (2, 3))
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float32, np.float64)
+    assert angles in ANGLE_ENCODINGS
     dtype_max = dtype_limits(image, clip_negative=False)[1]
 
     if low_threshold is None:
@@ -171,101 +411,7 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
     else:
         high_threshold = high_threshold / dtype_max
 
-    if mask is None:
-        mask = np.ones(image.shape, dtype=bool)
-
-    def fsmooth(x):
-        return img_as_float(gaussian(x, sigma, mode='constant'))
-
-    smoothed = smooth_with_function_and_mask(image, fsmooth, mask)
-#    jsobel = ndi.sobel(smoothed, axis=1)     #EH CHANGE
-    jsobel = ndi.sobel(smoothed, axis=1)/dx
-#    isobel = ndi.sobel(smoothed, axis=0)     #EH CHANGE
-    isobel = ndi.sobel(smoothed, axis=0)/dy
-    theta = np.arctan2(jsobel,-isobel)         #EH ADD
-    abs_isobel = np.abs(isobel)
-    abs_jsobel = np.abs(jsobel)
-    magnitude = np.hypot(isobel, jsobel)
-
-    #
-    # Make the eroded mask. Setting the border value to zero will wipe
-    # out the image edges for us.
-    #
-    s = generate_binary_structure(2, 2)
-    eroded_mask = binary_erosion(mask, s, border_value=0)
-    eroded_mask = eroded_mask & (magnitude > 0)
-    #
-    #--------- Find local maxima --------------
-    #
-    # Assign each point to have a normal of 0-45 degrees, 45-90 degrees,
-    # 90-135 degrees and 135-180 degrees.
-    #
-    local_maxima = np.zeros(image.shape, bool)
-    #----- 0 to 45 degrees ------
-    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
-    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    # Get the magnitudes shifted left to make a matrix of the points to the
-    # right of pts. Similarly, shift left and down to get the points to the
-    # top right of pts.
-    c1 = magnitude[1:, :][pts[:-1, :]]
-    c2 = magnitude[1:, 1:][pts[:-1, :-1]]
-    m = magnitude[pts]
-    w = abs_jsobel[pts] / abs_isobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[:-1, :][pts[1:, :]]
-    c2 = magnitude[:-1, :-1][pts[1:, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 45 to 90 degrees ------
-    # Mix diagonal and vertical
-    #
-    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
-    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1 = magnitude[:, 1:][pts[:, :-1]]
-    c2 = magnitude[1:, 1:][pts[:-1, :-1]]
-    m = magnitude[pts]
-    w = abs_isobel[pts] / abs_jsobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[:, :-1][pts[:, 1:]]
-    c2 = magnitude[:-1, :-1][pts[1:, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 90 to 135 degrees ------
-    # Mix anti-diagonal and vertical
-    #
-    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
-    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1a = magnitude[:, 1:][pts[:, :-1]]
-    c2a = magnitude[:-1, 1:][pts[1:, :-1]]
-    m = magnitude[pts]
-    w = abs_isobel[pts] / abs_jsobel[pts]
-    c_plus = c2a * w + c1a * (1.0 - w) <= m
-    c1 = magnitude[:, :-1][pts[:, 1:]]
-    c2 = magnitude[1:, :-1][pts[:-1, 1:]]
-    c_minus = c2 * w + c1 * (1.0 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 135 to 180 degrees ------
-    # Mix anti-diagonal and anti-horizontal
-    #
-    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
-    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1 = magnitude[:-1, :][pts[1:, :]]
-    c2 = magnitude[:-1, 1:][pts[1:, :-1]]
-    m = magnitude[pts]
-    w = abs_jsobel[pts] / abs_isobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[1:, :][pts[:-1, :]]
-    c2 = magnitude[1:, :-1][pts[:-1, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
+    theta, magnitude, local_maxima = canny_maxima(image, sigma, mask=mask, dx=dx, dy=dy, dtype=dtype)
 
     #
     #---- If use_quantiles is set then calculate the thresholds to use
@@ -276,8 +422,9 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
         if high_threshold < 0.0 or low_threshold < 0.0:
             raise ValueError("Quantile thresholds must not be < 0.0")
 
-        high_threshold = np.percentile(magnitude, 100.0 * high_threshold)
-        low_threshold = np.percentile(magnitude, 100.0 * low_threshold)
+        # per image when given a stack
+        high_threshold = np.percentile(magnitude, 100.0 * high_threshold, axis=(-2, -1), keepdims=True)
+        low_threshold = np.percentile(magnitude, 100.0 * low_threshold, axis=(-2, -1), keepdims=True)
 
     #
     #---- Create two masks at the two thresholds.
@@ -289,10 +436,10 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
     # Segment the low-mask, then only keep low-segments that have
     # some high_mask component in them
     #
-    strel = np.ones((3, 3), bool)
+    strel = planar_structure(np.ones((3, 3), bool), image.ndim)
     labels, count = label(low_mask, strel)
     if count == 0:
-        return low_mask
+        return encode_angles(np.full(image.shape, NO_EDGE, dtype), angles)
 
     sums = (np.array(ndi.sum(high_mask, labels,
                              np.arange(count, dtype=np.int32) + 1),
@@ -300,65 +447,94 @@ def canny(image, sigma=1., low_threshold=None, high_threshold=None, mask=None,
     good_label = np.zeros((count + 1,), bool)
     good_label[1:] = sums > 0
     output_mask = good_label[labels]
-    points = np.ma.masked_array(theta,mask=1-output_mask).filled(-999) # EH CHANGE
-    return points  # EH CHANGE
+    points = np.ma.masked_array(theta,mask=1-output_mask).filled(NO_EDGE) # EH CHANGE
+    return encode_angles(points, angles)  # EH CHANGE
 
 
+def _window_sums(fields,window):
+  # sum of each field over the asymmetric window [i-window,i+window) x [j-window,j+window)
+  box=np.ones(2*window)
+  return [ndi.correlate1d(ndi.correlate1d(f,box,axis=0,mode='constant'),box,axis=1,mode='constant') for f in fields]
+
 def canny_div(div,lon2,lat2,low_threshold=2e-5,high_threshold=2e-5,window=5):
+  """
+  Find ridges in div (e.g. convergence) and return their orientation.
+  Regions of div > low_threshold are labelled (4-connected). At every interior point
+  with div > high_threshold in a region of more than 100 points, the region's part of
+  the 2*window x 2*window box around the point defines a div-weighted inertia tensor;
+  the ridge runs along its major axis, and the point is kept if div has a local maximum
+  across it. Returns a masked array of ridge angles (radians, -pi/2..pi/2), masked
+  where there is no ridge.
+  The window sums are box filters over each region's bounding box and the major axis
+  comes from the closed-form 2x2 eigenvector, so no per-point Python work is done.
+  """
+  ny,nx=div.shape
   masked,n=label(div>low_threshold)
-  theta=-5*np.ones(div.shape)
-  nmasked=np.array([(masked==i).sum() for i in range(n+1)])
-  for i in range(window,div.shape[0]-window-1):
-    for j in range(window,div.shape[1]-window-1):
-      if div[i,j] > high_threshold and nmasked[masked[i,j]]>100:
-        xc = ((masked[i-window:i+window,j-window:j+window] == masked[i,j])*lon2[i-window:i+window,j-window:j+window]).sum()/(masked[i-window:i+window,j-window:j+window] == masked[i,j]).sum()
-        yc = ((masked[i-window:i+window,j-window:j+window] == masked[i,j])*lat2[i-window:i+window,j-window:j+window]).sum()/(masked[i-window:i+window,j-window:j+window] == masked[i,j]).sum()
-        div_m = div[i-window:i+window,j-window:j+window]*(masked[i-window:i+window,j-window:j+window] == masked[i,j])
-        ixx=(div_m*(lon2[i-window:i+window,j-window:j+window]-xc)**2).mean()
-        ixy=(div_m*(lon2[i-window:i+window,j-window:j+window]-xc)*(lat2[i-window:i+window,j-window:j+window]-yc)).mean()
-        iyy=(div_m*(lat2[i-window:i+window,j-window:j+window]-yc)**2).mean()
-        m = np.array([[ixx,ixy],[ixy,iyy]])
-        w,v=np.linalg.eig(m)
-        if w[1]<w[0]:
-          v = v[:,[1,0]]
-          w = w[[1,0]]
-        # v[:,1] has the smaller eigenvalue
-        # v[:,0] has the bigger eigenvalue 
-#        theta[i,j] = (np.arctan2(v[0,0],v[1,0])+np.pi/2)%np.pi-np.pi/2
-        theta_tmp = np.arctan2(v[0,1],v[1,1])
-        theta_tmp = theta_tmp%np.pi-np.pi/2.0
-        a=-np.sin(theta_tmp)
-        b=np.cos(theta_tmp)
-        if 0 <= theta_tmp <=np.pi/4:
-          dx_m = div[i,j+1]-div[i,j]
-          dx_p = div[i,j]-div[i,j-1]
-          dc_m = div[i+1,j-1]-div[i,j]
-          dc_p = div[i,j]-div[i-1,j+1]
-          d_m = (a+b)*dx_m - b*dc_m
-          d_p = (a+b)*dx_p - b*dc_p
-        elif np.pi/4 <= theta_tmp < np.pi/2:
-          dy_m = div[i+1,j]-div[i,j]
-          dy_p = div[i,j]-div[i-1,j]
-          dc_m = div[i+1,j-1]-div[i,j]
-          dc_p = div[i,j]-div[i-1,j+1]
-          d_m = (a+b)*dy_m + a*dc_m
-          d_p = (a+b)*dy_p + a*dc_p
-        elif -np.pi/4 <= theta_tmp < 0:
-          dy_m = div[i+1,j]-div[i,j]
-          dy_p = div[i,j]-div[i-1,j]
-          dd_m = div[i+1,j+1]-div[i,j]
-          dd_p = div[i,j]-div[i-1,j-1]
-          d_m = (b-a)*dy_m + a*dd_m
-          d_p = (b-a)*dy_p + a*dd_p
-        elif -np.pi/2 <= theta_tmp < -np.pi/4:
-          dx_m = div[i,j+1]-div[i,j]
-          dx_p = div[i,j]-div[i,j-1]
-          dd_m = div[i+1,j+1]-div[i,j]
-          dd_p = div[i,j]-div[i-1,j-1]
-          d_m = (b-a)*dx_m + b*dd_m
-          d_p = (b-a)*dx_p + b*dd_p
-        if (d_m*d_p)<0:
-          theta[i,j]=theta_tmp
+  theta=-5*np.ones(div.shape,dtype=np.result_type(div.dtype,np.float32))
+  nmasked=np.bincount(masked.ravel(),minlength=n+1)
+  # candidate points, restricted to where a full window fits
+  cand=(div>high_threshold)&(nmasked[masked]>100)
+  interior=np.zeros(div.shape,bool)
+  interior[window:ny-window-1,window:nx-window-1]=True
+  cand&=interior
+  if not cand.any():
+    return np.ma.masked_array(theta,mask=(theta==-5))
+  ixx=np.zeros(div.shape)
+  ixy=np.zeros(div.shape)
+  iyy=np.zeros(div.shape)
+  objects=ndi.find_objects(masked)
+  for lab in np.unique(masked[cand]):
+    if lab==0:
+      # only reachable when high_threshold < low_threshold
+      rows,cols=slice(0,ny),slice(0,nx)
+    else:
+      rows,cols=objects[lab-1]
+    # the region's bounding box grown by the window, so every window of its points is inside
+    rows=slice(max(rows.start-window,0),min(rows.stop+window,ny))
+    cols=slice(max(cols.start-window,0),min(cols.stop+window,nx))
+    same=(masked[rows,cols]==lab).astype(float)
+    at=cand[rows,cols]&(masked[rows,cols]==lab)
+    # coordinates relative to the box centre to keep the moment sums well conditioned
+    x=lon2[rows,cols]-lon2[rows,cols].mean()
+    y=lat2[rows,cols]-lat2[rows,cols].mean()
+    d=div[rows,cols]*same
+    count,sx,sy,sd,sdx,sdy,sdxx,sdxy,sdyy=[f[at] for f in _window_sums(
+      [same,same*x,same*y,d,d*x,d*y,d*x*x,d*x*y,d*y*y],window)]
+    # window centroid of the region, then div-weighted second moments about it
+    xc=sx/count
+    yc=sy/count
+    ixx[rows,cols][at]=sdxx-2*xc*sdx+xc*xc*sd
+    ixy[rows,cols][at]=sdxy-xc*sdy-yc*sdx+xc*yc*sd
+    iyy[rows,cols][at]=sdyy-2*yc*sdy+yc*yc*sd
+  ii,jj=np.nonzero(cand)
+  a_,b_,c_=ixx[ii,jj],ixy[ii,jj],iyy[ii,jj]
+  # major axis of [[a,b],[b,c]] is at angle phi=atan2(2b,a-c)/2 from x; for an isotropic
+  # tensor np.linalg.eig returned the y axis, so keep that choice
+  phi=0.5*np.arctan2(2*b_,a_-c_)
+  phi[(b_==0)&(a_==c_)]=np.pi/2
+  theta_tmp=np.arctan2(np.cos(phi),np.sin(phi))
+  theta_tmp=theta_tmp%np.pi-np.pi/2.0
+  a=-np.sin(theta_tmp)
+  b=np.cos(theta_tmp)
+  # differences along the grid axes and diagonals
+  c=div[ii,jj]
+  dx_m=div[ii,jj+1]-c
+  dx_p=c-div[ii,jj-1]
+  dy_m=div[ii+1,jj]-c
+  dy_p=c-div[ii-1,jj]
+  dc_m=div[ii+1,jj-1]-c
+  dc_p=c-div[ii-1,jj+1]
+  dd_m=div[ii+1,jj+1]-c
+  dd_p=c-div[ii-1,jj-1]
+  # interpolate across the ridge in whichever 45 degree sector it points
+  sectors=[(0<=theta_tmp)&(theta_tmp<=np.pi/4),
+           (np.pi/4<=theta_tmp)&(theta_tmp<np.pi/2),
+           (-np.pi/4<=theta_tmp)&(theta_tmp<0),
+           (-np.pi/2<=theta_tmp)&(theta_tmp<-np.pi/4)]
+  d_m=np.select(sectors,[(a+b)*dx_m-b*dc_m,(a+b)*dy_m+a*dc_m,(b-a)*dy_m+a*dd_m,(b-a)*dx_m+b*dd_m],np.nan)
+  d_p=np.select(sectors,[(a+b)*dx_p-b*dc_p,(a+b)*dy_p+a*dc_p,(b-a)*dy_p+a*dd_p,(b-a)*dx_p+b*dd_p],np.nan)
+  ridge=(d_m*d_p)<0
+  theta[ii[ridge],jj[ridge]]=theta_tmp[ridge]
   theta=np.ma.masked_array(theta,mask=(theta==-5))#%np.pi
   return theta
 
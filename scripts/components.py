@@ -0,0 +1,95 @@
+"""
+components.py - connected components of edge masks and their statistics
+
+Components are labelled with 8-connectivity in the two trailing (spatial) axes
+only, so a (time, lat, lon) stack is labelled slice by slice in one call.
+Per-component statistics come from label histograms (``np.bincount`` with
+weights) and ``find_objects``, one pass over the array whatever the number of
+components, instead of comparing the whole label array with every label.
+"""
+import numpy as np
+from scipy.ndimage import find_objects, label
+
+from canny_mod import planar_structure
+
+EIGHT_CONNECTED = np.ones((3, 3), bool)
+FOUR_CONNECTED = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], bool)
+
+
+def label_components(mask, structure=EIGHT_CONNECTED):
+    """Label ``mask`` (2D, or a stack of 2D slices) with a 2D ``structure``; returns (labels, n)."""
+    mask = np.asarray(mask)
+    return label(mask, structure=planar_structure(structure, mask.ndim))
+
+
+def component_sizes(labels, n):
+    """Number of points in each label 0..n (index 0 counts the background)."""
+    return np.bincount(labels.ravel(), minlength=n + 1)
+
+
+def remove_small(mask, minlen, structure=EIGHT_CONNECTED):
+    """Zero the components of ``mask`` with ``minlen`` points or fewer, keeping mask's dtype."""
+    labels, n = label_components(mask, structure)
+    size = component_sizes(labels, n)
+    size[0] = 0
+    return (size[labels] > minlen)*mask
+
+
+def component_stats(labels, n, lon2=None, lat2=None):
+    """
+    Statistics of components 1..n of a label array (2D, or a stack labelled per slice).
+    Parameters
+    ----------
+    labels : int array
+       output of ``label_components``
+    n : int
+       number of components
+    lon2, lat2 : 2D arrays or None
+       coordinates of the trailing two axes; grid indices are used if None
+    Returns
+    -------
+    dict of arrays indexed by label (entry 0, the background, is zero or NaN):
+    "size" (points), "slice" (index along the leading axis; 0 for 2D input),
+    "ymin", "ymax", "xmin", "xmax" (index bounding box, inclusive),
+    "mean_lon", "mean_lat", and "orientation", the angle (radians, -pi/2..pi/2,
+    anticlockwise from east) of the component's major axis in lon/lat space.
+    """
+    ny, nx = labels.shape[-2:]
+    if lon2 is None or lat2 is None:
+        lat2, lon2 = np.mgrid[0:ny, 0:nx].astype(float)
+    flat = labels.ravel()
+    # coordinates of every point, broadcast over the stack
+    x = np.broadcast_to(lon2, labels.shape).ravel()
+    y = np.broadcast_to(lat2, labels.shape).ravel()
+    size = np.bincount(flat, minlength=n + 1).astype(float)
+    size[0] = 0
+
+    def total(weights):
+        return np.bincount(flat, weights=weights, minlength=n + 1)
+
+    # background (label 0) has size 0 and gets means of 0 here, NaN in the output
+    mean_lon = np.divide(total(x), size, out=np.zeros(n + 1), where=size > 0)
+    mean_lat = np.divide(total(y), size, out=np.zeros(n + 1), where=size > 0)
+    # central second moments, shifted by the means so long components stay well conditioned
+    dx = x - mean_lon[flat]
+    dy = y - mean_lat[flat]
+    cxx = total(dx*dx)
+    cyy = total(dy*dy)
+    cxy = total(dx*dy)
+    orientation = 0.5*np.arctan2(2*cxy, cxx - cyy)
+
+    stats = {"size": size.astype(int), "slice": np.zeros(n + 1, int),
+             "ymin": np.zeros(n + 1, int), "ymax": np.zeros(n + 1, int),
+             "xmin": np.zeros(n + 1, int), "xmax": np.zeros(n + 1, int),
+             "mean_lon": mean_lon, "mean_lat": mean_lat, "orientation": orientation}
+    for lab, box in enumerate(find_objects(labels, max_label=n), start=1):
+        if box is None:
+            continue
+        if labels.ndim > 2:
+            stats["slice"][lab] = box[0].start
+        stats["ymin"][lab], stats["ymax"][lab] = box[-2].start, box[-2].stop - 1
+        stats["xmin"][lab], stats["xmax"][lab] = box[-1].start, box[-1].stop - 1
+    for key in ("mean_lon", "mean_lat", "orientation"):
+        stats[key][0] = np.nan
+    return stats
+
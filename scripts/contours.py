@@ -0,0 +1,72 @@
+"""
+contours.py - outline of the largest region of a thresholded field
+
+Instead of tracing every contour of a global mask and building a polygon for
+each to keep the largest, the mask is labelled, the largest region by pixel
+count is picked, and only that region is traced, inside its bounding box.
+Marching-squares vertices keep their sub-pixel positions: they are mapped to
+lon/lat by linear interpolation of the grid coordinates rather than truncated
+to grid indices. One polygon is built.
+"""
+import numpy as np
+from scipy.ndimage import find_objects
+from shapely.geometry import Polygon
+from skimage import measure
+
+from components import FOUR_CONNECTED, component_sizes, label_components
+
+
+def largest_region(mask, structure=FOUR_CONNECTED):
+    """
+    The largest connected region of a 2D boolean ``mask`` by pixel count.
+    Returns (region, box): the region as a boolean array over ``box``, the
+    (row, col) slices of its bounding box, or (None, None) if mask is empty.
+    4-connected by default, which is how marching squares separates regions.
+    """
+    labels, n = label_components(mask, structure)
+    if n == 0:
+        return None, None
+    size = component_sizes(labels, n)
+    size[0] = 0
+    biggest = int(np.argmax(size))
+    box = find_objects(labels == biggest, max_label=1)[0]
+    return labels[box] == biggest, box
+
+
+def _area(contour):
+    """Signed shoelace area of a closed (row, col) contour."""
+    y, x = contour[:, 0], contour[:, 1]
+    return 0.5*(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def outline(region):
+    """
+    Outer boundary of a single region (boolean array) as (row, col) vertices
+    from marching squares at level 0.5, in the region array's index space.
+    The region is padded by one cell so its boundary always closes; holes give
+    inner contours, so the outer one is the contour enclosing the most area.
+    """
+    padded = np.pad(region, 1).astype(np.uint8)
+    contours = measure.find_contours(padded, level=0.5)
+    outer = max(contours, key=lambda c: abs(_area(c)))
+    return outer - 1
+
+
+def to_lonlat(rows, cols, lon, lat):
+    """Map fractional grid indices to lon/lat by linear interpolation of 1D coordinates."""
+    return (np.interp(cols, np.arange(len(lon)), lon),
+            np.interp(rows, np.arange(len(lat)), lat))
+
+
+def largest_region_polygon(mask, lon, lat):
+    """
+    Polygon (lon/lat) around the largest region of ``mask`` (2D, dims lat, lon),
+    or None if the mask is empty or the outline is not a valid polygon.
+    """
+    region, box = largest_region(np.asarray(mask, bool))
+    if region is None:
+        return None
+    contour = outline(region)
+    lons, lats = to_lonlat(contour[:, 0] + box[0].start, contour[:, 1] + box[1].start, lon, lat)
+    poly = Polygon(zip(lons, lats))
+    return poly if poly.is_valid else None
@@ -0,0 +1,119 @@
+"""
+derivatives.py - finite differences on N-dimensional gridded fields
+
+Centred differences in the interior and one-sided differences at the array
+boundaries, computed with whole-array slicing. Missing data is described by an
+explicit boolean validity array rather than ``np.ma``: next to an invalid point
+the derivative falls back to the one-sided difference on the valid side, and it
+is invalid where neither side is. This reproduces ``drylines.ddx``/``ddy``.
+"""
+import numpy as np
+
+
+def _float_dtype(var, spacing):
+    """float32 if ``var`` is float32 and ``spacing`` a scalar or float32 array, otherwise float64."""
+    h = np.asarray(spacing)
+    if var.dtype == np.float32 and (h.ndim == 0 or h.dtype == np.float32):
+        return np.float32
+    return np.float64
+
+
+def _spacing(spacing, ndim, axis, n):
+    """
+    Broadcast ``spacing`` against an ``ndim`` array differentiated along ``axis``:
+    a scalar, a 1D array of length ``n`` (one value per point along ``axis``), or a
+    2D (ny, nx) array for the two trailing dimensions, as returned by ``get_dxdy``.
+    """
+    h = np.asarray(spacing)
+    if h.ndim == 0:
+        return h
+    if h.ndim == 1:
+        if len(h) != n:
+            raise ValueError(f"1D spacing has length {len(h)}, expected {n}")
+        shape = [1]*ndim
+        shape[axis] = n
+        return h.reshape(shape)
+    if h.ndim == 2:
+        if ndim < 2 or axis < ndim - 2:
+            raise ValueError("2D spacing only applies along the last two dimensions")
+        return h.reshape((1,)*(ndim - 2) + h.shape)
+    raise ValueError(f"spacing must be a scalar, 1D or 2D, got {h.ndim} dimensions")
+
+
+def _take(a, axis, start, stop):
+    """``a[..., start:stop, ...]`` along ``axis``; scalars are returned unchanged."""
+    if a.ndim == 0:
+        return a
+    index = [slice(None)]*a.ndim
+    index[axis] = slice(start, stop)
+    return a[tuple(index)]
+
+
+def derivative(var, spacing=1.0, axis=-1, valid=None):
+    """
+    Derivative of ``var`` along ``axis``.
+    Parameters
+    ----------
+    var : array
+       field to differentiate, any number of dimensions (at least 2 points along ``axis``)
+    spacing : float, 1D or 2D array
+       grid spacing; see ``_spacing``
+    axis : int
+       dimension to differentiate along
+    valid : boolean array or None
+       True where ``var`` holds data; None if every point is valid
+    Returns
+    -------
+    dvar, or (dvar, valid_out) if ``valid`` is given. The result is float32 when
+    ``var`` is float32 (and ``spacing`` a scalar or float32), float64 otherwise; invalid points hold 0.
+    """
+    var = np.asarray(var)
+    axis = axis % var.ndim
+    n = var.shape[axis]
+    if n < 2:
+        raise ValueError("need at least 2 points along the differentiation axis")
+    dtype = _float_dtype(var, spacing)
+    var = var.astype(dtype, copy=False)
+    h = _spacing(spacing, var.ndim, axis, n).astype(dtype, copy=False)
+
+    # one-sided at the boundaries
+    first, last = [slice(None)]*var.ndim, [slice(None)]*var.ndim
+    first[axis], last[axis] = slice(0, 1), slice(n - 1, n)
+    first, last = tuple(first), tuple(last)
+    dvar = np.empty(var.shape, dtype)
+    np.subtract(_take(var, axis, 1, 2), _take(var, axis, 0, 1), out=dvar[first])
+    dvar[first] /= _take(h, axis, 0, 1)
+    np.subtract(_take(var, axis, n - 1, n), _take(var, axis, n - 2, n - 1), out=dvar[last])
+    dvar[last] /= _take(h, axis, n - 1, n)
+
+    # centred in the interior: the mean of the forward and backward differences,
+    # built in place to keep temporaries to one array
+    interior = [slice(None)]*var.ndim
+    interior[axis] = slice(1, n - 1)
+    interior = tuple(interior)
+    h_in = _take(h, axis, 1, n - 1)
+    centre = _take(var, axis, 1, n - 1)
+    forward = dvar[interior]
+    np.subtract(_take(var, axis, 2, n), centre, out=forward)
+    forward /= h_in
+    backward = np.subtract(centre, _take(var, axis, 0, n - 2))
+    backward /= h_in
+    if valid is None:
+        forward += backward
+        forward *= 0.5
+        return dvar
+
+    valid = np.asarray(valid, bool)
+    step_ok = _take(valid, axis, 0, n - 1) & _take(valid, axis, 1, n)
+    fwd_ok = _take(step_ok, axis, 1, n - 1)
+    bwd_ok = _take(step_ok, axis, 0, n - 2)
+    with np.errstate(invalid="ignore", over="ignore"):
+        forward[...] = np.where(fwd_ok & bwd_ok, (forward + backward)*0.5,
+                                np.where(fwd_ok, forward, backward))
+    valid_out = np.empty(var.shape, bool)
+    valid_out[first] = _take(step_ok, axis, 0, 1)
+    valid_out[last] = _take(step_ok, axis, n - 2, n - 1)
+    valid_out[interior] = fwd_ok | bwd_ok
+    dvar[~valid_out] = 0
+    return dvar, valid_out
+
@@ -0,0 +1,54 @@
+"""
+domain.py - subset global grids to the Africa analysis domain
+
+Every product is confined to Africa, so fields are cut down to the Africa
+bounding box plus a halo before any smoothing, edge detection or contouring.
+The halo is wide enough that every grid cell inside Africa sees exactly the
+same neighbourhood it would on the global grid, so results are unchanged.
+"""
+from masks import load_africa
+
+
+def halo_cells(window=0, sigma=0, truncate=4.0):
+    """
+    Number of grid cells a field must extend beyond the region of interest.
+    Parameters
+    ----------
+    window : int
+       Width of a centred rolling window (an even window reaches window//2 cells)
+    sigma : float
+       Gaussian smoothing scale in grid cells, as passed to ``find_edge``
+    truncate : float
+       Gaussian truncation (scipy's default); the kernel reaches int(truncate*sigma+0.5) cells,
+       and the Sobel gradient and non-maximum suppression each reach one cell further
+    """
+    edge = int(truncate*sigma + 0.5) + 2 if sigma else 0
+    return max(window//2, edge)
+
+
+def africa_bbox(res, window=0, sigma=0):
+    """
+    Return ``(west, south, east, north)`` in degrees: the Africa bounding box
+    grown by ``halo_cells(window, sigma)`` cells of size ``res`` degrees.
+    """
+    west, south, east, north = load_africa().bounds
+    halo = halo_cells(window, sigma)*res
+    return (max(west - halo, -180.0), max(south - halo, -90.0),
+            min(east + halo, 180.0), min(north + halo, 90.0))
+
+
+def normalize_lon(da):
+    """Convert 0..360 longitudes to -180..180 and sort, so Africa is contiguous."""
+    if float(da.longitude.max()) > 180:
+        lon = (((da.longitude + 180) % 360) - 180).values
+        da = da.assign_coords(longitude=("longitude", lon)).sortby("longitude")
+    return da
+
+
+def crop(da, bbox):
+    """Select the part of ``da`` inside ``bbox``, whichever way its latitudes run."""
+    west, south, east, north = bbox
+    lat = da.latitude.values
+    lat_slice = slice(north, south) if lat[0] > lat[-1] else slice(south, north)
+    return da.sel(latitude=lat_slice, longitude=slice(west, east))
+
@@ -1,10 +1,24 @@
 
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.ndimage import gaussian_filter,label
-from canny_mod import canny,canny_div
+import itertools
+from canny_mod import canny,canny_maxima,canny_div,dtype_limits,NO_EDGE
+from components import remove_small
+from edge_points import EdgePoints
+from derivatives import derivative
 # import cmocean
 
+# ------------------------
+# Config
+# ------------------------
+# Edge-detector precision ("float64" or "float32"); EDGE_VALIDATE=1 also runs float64 and reports differences
+EDGE_DTYPE=np.dtype(os.getenv("EDGE_DTYPE","float64"))
+EDGE_VALIDATE=os.getenv("EDGE_VALIDATE","0")=="1"
+# Encoding of the edge angles the scripts keep in EdgePoints ("float", "float16" or "int8", see canny_mod.encode_angles)
+EDGE_ANGLES=os.getenv("EDGE_ANGLES","int8")
+
 
 def dxdy(lon,lat):
   # calculates grid spacing in metres
@@ -17,14 +31,14 @@ def dxdy(lon,lat):
   dy = np.gradient(lat2)[0]*r*np.pi/180.0
   return dx,dy
 
-def get_dxdy(lon,lat,relative='Grid Cell'):
-  # calculates grid spacing in various units
+def get_dxdy(lon,lat,relative='Grid Cell',dtype=np.float64):
+  # calculates grid spacing in various units, as dtype arrays (or python floats for "Grid Cell")
   assert(relative in ["Grid Cell","Weighted Grid Cell","Degrees","metres","meters"])
   if relative=="Grid Cell":
-    dx,dy = 1.0,1.0
+    return 1.0,1.0
   elif relative=="Weighted Grid Cell":
     dx,dy=dxdy(lon,lat)
-    mean = (dx.abs().mean()+dy.abs().mean())/2.0
+    mean = (np.abs(dx).mean()+np.abs(dy).mean())/2.0
     dx/= mean
     dy/= mean
   elif relative=="Degrees":
@@ -37,108 +51,56 @@ def get_dxdy(lon,lat,relative='Grid Cell'):
     dx,dy=np.meshgrid(dx,dy) 
   elif relative in ["metres","meters"]:
     dx,dy=dxdy(lon,lat)
-  return(dx,dy)
+  return(dx.astype(dtype),dy.astype(dtype))
+
+def _masked_derivative(var,spacing,axis):
+  # derivative of a plain or masked array, masked where derivatives.derivative marks it invalid
+  mask=np.ma.getmask(var)
+  if mask is np.ma.nomask:
+    return np.ma.masked_array(derivative(np.asarray(var),spacing,axis=axis))
+  dvar,valid=derivative(np.ma.getdata(var),spacing,axis=axis,valid=~np.ma.getmaskarray(var))
+  return np.ma.masked_array(dvar,mask=~valid)
 
 def ddy(var,dy):
 #
-# Calculate meridional derivative. Assumes y is 2nd last dimension, works for 2,3,4 dim grids
+# Calculate meridional derivative. Assumes y is 2nd last dimension, works for any grid of 2+ dims
 #  first order centred difference unless boundary point or next to masked value
+#  dy may be a scalar, 1D (one value per row) or 2D (lat,lon); see derivatives.py
 #
     if len(var.shape) <2:
         print("Cannot not supported for shapes of 0 or 1. Just use np.gradient?")
         return
-    if len(var.shape) >4:
-        print("Cannot not supported for shape > 4")
-        return
-    if type(dy)==float:
-      dy=dy*np.ones((var.shape[-2],var.shape[-1]))
-    if len(var.shape) == 4:
-        nt,nz,ny,nx = var.shape
-        dvar = np.ma.zeros((nt,nz,ny,nx))
-        tmp2 = np.ma.zeros((nt,nz,ny,nx))
-        tmp3 = np.ma.zeros((nt,nz,ny,nx))
-        for i in range(ny-2):
-            tmp2[:,:,i+1] = (var[:,:,i+2]-var[:,:,i+1])/(dy[i+1])
-            tmp3[:,:,i+1] = (var[:,:,i+1]-var[:,:,i])/(dy[i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()#tmp4.copy()
-        dvar[:,:,0] = (var[:,:,1]-var[:,:,0])/dy[0]
-        dvar[:,:,-1] = (var[:,:,-1]-var[:,:,-2])/dy[-1]
-    if len(var.shape) == 3:
-        nz,ny,nx = var.shape
-        dvar = np.ma.zeros((nz,ny,nx))
-        tmp2 = np.ma.zeros((nz,ny,nx))
-        tmp3 = np.ma.zeros((nz,ny,nx))
-        for i in range(ny-2):
-            tmp2[:,i+1] = (var[:,i+2]-var[:,i+1])/(dy[i+1])
-            tmp3[:,i+1] = (var[:,i+1]-var[:,i])/(dy[i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()#tmp4.copy()
-        dvar[:,0] = (var[:,1]-var[:,0])/dy[0]
-        dvar[:,-1] = (var[:,-1]-var[:,-2])/dy[-1]
-    if len(var.shape) == 2:
-        ny,nx = var.shape
-        dvar = np.ma.zeros((ny,nx))
-        tmp2 = np.ma.zeros((ny,nx))
-        tmp3 = np.ma.zeros((ny,nx))
-        for i in range(ny-2):
-            tmp2[i+1] = (var[i+2]-var[i+1])/(dy[i+1])
-            tmp3[i+1] = (var[i+1]-var[i])/(dy[i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()#tmp4.copy()
-        dvar[0] = (var[1]-var[0])/dy[0]
-        dvar[-1] = (var[-1]-var[-2])/dy[-1]
-    return dvar
+    return _masked_derivative(var,dy,-2)
 
 def ddx(var,dx):
 #
-# Calculate zonal derivative. Assumes x is last dimension, works for 2,3,4 dim grids
+# Calculate zonal derivative. Assumes x is last dimension, works for any grid of 2+ dims
 #  first order centred difference unless boundary point or next to masked value
+#  dx may be a scalar, 1D (one value per column) or 2D (lat,lon); see derivatives.py
 #
     if len(var.shape) <2:
         print("Cannot not supported for shapes of 0 or 1. Just use np.gradient?")
         return
-    if len(var.shape) >4:
-        print("Cannot not supported for shape > 4")
-        return
-    if type(dx)==float:
-      dx=dx*np.ones((var.shape[-2],var.shape[-1]))
-    if len(var.shape) == 4:
-        nt,nz,ny,nx = var.shape
-        dvar = np.ma.zeros((nt,nz,ny,nx))
-        tmp2 = np.ma.zeros((nt,nz,ny,nx))
-        tmp3 = np.ma.zeros((nt,nz,ny,nx))
-        for i in range(nx-2):
-            tmp2[:,:,:,i+1] = (var[:,:,:,i+2]-var[:,:,:,i+1])/(dx[:,i+1])
-            tmp3[:,:,:,i+1] = (var[:,:,:,i+1]-var[:,:,:,i])/(dx[:,i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()
-        dvar[:,:,:,0] = (var[:,:,:,1]-var[:,:,:,0])/dx[:,0]
-        dvar[:,:,:,-1] = (var[:,:,:,-1]-var[:,:,:,-2])/dx[:,-1]
-    if len(var.shape) == 3:
-        nz,ny,nx = var.shape
-        dvar = np.ma.zeros((nz,ny,nx))
-        tmp2 = np.ma.zeros((nz,ny,nx))
-        tmp3 = np.ma.zeros((nz,ny,nx))
-        for i in range(nx-2):
-            tmp2[:,:,i+1] = (var[:,:,i+2]-var[:,:,i+1])/(dx[:,i+1])
-            tmp3[:,:,i+1] = (var[:,:,i+1]-var[:,:,i])/(dx[:,i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()
-        dvar[:,:,0] = (var[:,:,1]-var[:,:,0])/dx[:,0]
-        dvar[:,:,-1] = (var[:,:,-1]-var[:,:,-2])/dx[:,-1]
-    elif len(var.shape) == 2:
-        ny,nx = var.shape
-        dvar = np.ma.zeros((ny,nx))
-        tmp2 = np.ma.zeros((ny,nx))
-        tmp3 = np.ma.zeros((ny,nx))
-        for i in range(nx-2):
-            tmp2[:,i+1] = (var[:,i+2]-var[:,i+1])/(dx[:,i+1])
-            tmp3[:,i+1] = (var[:,i+1]-var[:,i])/(dx[:,i+1])
-        dvar = np.ma.mean((tmp2,tmp3),axis=0).copy()
-        dvar[:,0] = (var[:,1]-var[:,0])/dx[:,0]
-        dvar[:,-1] = (var[:,-1]-var[:,-2])/dx[:,-1]
-    return dvar
+    return _masked_derivative(var,dx,-1)
+
+def divergence(u,v,lon,lat):
+#
+# Horizontal divergence (s-1) of winds u,v (m/s; dimensions ...,lat,lon) on a lon/lat grid.
+#  du/dx + dv/dy - v*tan(lat)/a: centred differences over the dxdy spacing in metres, plus
+#  the spherical metric term. Latitudes may run either way (dy is then negative).
+#
+  if len(lon.shape)==1:
+    lon2,lat2=np.meshgrid(lon,lat)
+  else:
+    lon2,lat2=lon,lat
+  dx,dy=dxdy(lon,lat)
+  r = 6371000
+  return derivative(u,dx,axis=-1)+derivative(v,dy,axis=-2)-np.asarray(v)*np.tan(lat2*np.pi/180.0)/r
 
 
 
 
-def find_edge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1,spatial_mask=1,relative="Grid Cell",output='sparse',plotfreq=0,times=None,makefig=None):
+def find_edge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1,spatial_mask=1,relative="Grid Cell",output='sparse',plotfreq=0,times=None,makefig=None,dtype=np.float64,validate=False,angles="float"):
    """
    Apply an edge filter to 3D atmospheric fields (probably surface q or RH with current setup)
    Calls a slightly modified version of the skimage canny algorithm
@@ -164,10 +126,12 @@ def find_edge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1
       Masked location where edges will be sought
    relative : "Grid Cell","Weighted Grid Cell","Degrees","metres" or "meters"
       denominator units for mag_min
-   output : "sparse" or "lists"
+   output : "sparse", "points" or "lists"
       Controls output type. 
       If "sparse", returns a sparse boolean array with same shape as data,
                    containing 1s where edge is detected
+      If "points", returns an edge_points.EdgePoints holding only the edge pixels
+                   and their angles (memory scales with the number of edges)
       If "lists", returns 2 lists of lists, containing lat and lon cooordinates
                    of detected edges for each day
    plotfreq : float between 0 and 1
@@ -180,6 +144,14 @@ def find_edge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1
    makefig : function
       option to make more sophisticated plots if plotfreq>0 
       leave as None to get basic plots
+   dtype : np.float64 or np.float32
+      precision of the edge detection. float32 halves memory and bandwidth and suits
+      fields that are float32 anyway (GRIB humidity); edges can differ at near-ties
+   validate : bool
+      with a float32 dtype, also run in float64 and print how many edge points differ
+   angles : "float", "float16" or "int8"
+      encoding of the angles kept with output="points" (see canny_mod.encode_angles);
+      "int8" stores an eighth of float64, to within about 0.0125 rad
    """
  # Assertations that input shapes are correct
    assert(len(data.shape)>=2)
@@ -197,65 +169,160 @@ def find_edge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1
      assert(len(spatial_mask.shape)==2)
      assert(spatial_mask.shape==data[0].shape)
    assert(relative in ["Grid Cell","Weighted Grid Cell","Degrees","metres","meters"])
- # Create spatial grid weights 
-   dx,dy=get_dxdy(lon,lat,relative=relative)
-   if type(dx) in [float,int]:
-     dx=dx*np.ones(lon2.shape,dtype=float)
-     dy=dy*np.ones(lon2.shape,dtype=float)
-   assert output in ['sparse','lists']
-   if output=='sparse':
-     gather = []
-   elif output=='lists':
+   assert output in ['sparse','points','lists']
+   if output=='lists':
      gather=[],[]
    if times==None:
      times=range(len(data))
    else:
      assert(len(times)==len(data))
+   # find all edges, in one call for the whole stack (each slice is handled independently)
+   stage=edge_stage(data,lon,lat,sigma,relative=relative,dtype=dtype)
+   # threshold, restrict to desired angles and locations, and drop short edges
+   points,filt=apply_edge_spec(stage,theta_max=theta_max,theta_min=theta_min,mag_min=mag_min,minlen=minlen,spatial_mask=spatial_mask)
+   if validate and np.dtype(dtype)!=np.float64:
+     ref=find_edge(data,lon,lat,sigma,theta_max=theta_max,theta_min=theta_min,mag_min=mag_min,minlen=minlen,spatial_mask=spatial_mask,relative=relative,dtype=np.float64)
+     ndiff=((ref!=0)!=(filt!=0)).sum()
+     print(f"find_edge validation: {np.dtype(dtype)} edges differ from float64 at {ndiff} of {(ref!=0).sum()} edge points")
+   if output=='sparse':
+     gather=filt
+   elif output=='points':
+     gather=EdgePoints.from_mask(filt,lon,lat,angles=points,encoding=angles)
    pi=0
-   # iterate through time
-   for tt,d in zip(times,data):
-     # find all edges
-     points=canny(d,sigma=sigma,dx=dx,dy=dy,low_threshold=mag_min,high_threshold=mag_min)#,mask=1-mask
-     # restrict to desired angles and locations
-     filt=(points<theta_max)*(points>theta_min)*spatial_mask
-     # filter out edges that are too short
-     mask,n=label(filt,structure=np.ones((3,3),dtype=bool))
-     nmasked=np.array([(mask==j).sum() for j in range(n+1)])
-     nmasked[0]=0
-     filt = (nmasked[mask]>minlen)*filt
-     # add to output array or lists
-     if output=='sparse':
-       gather.append(filt)
+   for k,tt in enumerate(times):
+     # add to output lists
      if output=='lists':
-        flat=filt.flatten()
+        flat=filt[k].flatten()
         gather[0].append(lon2.flatten()[flat!=0])
         gather[1].append(lat2.flatten()[flat!=0])
      rand=np.random.rand()
      if rand < plotfreq:
         # plot edges and background data
+        d=data[k]
         pi+=1
         plt.subplot(5,6,pi,aspect=1)
         if makefig==None:
           plt.title(tt)
           plt.contourf(lon,lat,d,np.linspace(data.min(),data.max(),20),cmap='Greys')
-          plt.pcolor(lon,lat,np.ma.masked_array(points,1-filt),vmin=-np.pi,vmax=np.pi)
+          plt.pcolor(lon,lat,np.ma.masked_array(points[k],1-filt[k]),vmin=-np.pi,vmax=np.pi)
         else:
-          makefig(d,tt,points,filt)
+          makefig(d,tt,points[k],filt[k])
         if pi == 30:
           plt.show()
           pi=0
    if plotfreq>0:
      plt.show()
-   if output=='sparse':
-     gather=np.array(gather)
    return gather
 
 
+#
+# parameter sweeps: one canny stage, many filters
+#
+
+def edge_stage(data,lon,lat,sigma,relative="Grid Cell",dtype=np.float64,spacing=None):
+   """
+   Run the expensive, threshold-independent part of find_edge once: smoothing,
+   gradients and non-maximum suppression of data (time,lat,lon) at this sigma.
+   Returns a dict holding the edge angles ("theta"), gradient magnitudes
+   ("magnitude") and thinned edge candidates ("maxima"), plus the coordinates
+   and magnitude scale apply_edge_spec needs. Pass it to apply_edge_spec (or use
+   edge_sweep) to evaluate any number of angle windows, thresholds, minimum
+   lengths and masks without recomputing it. spacing, if given, is the (dx,dy)
+   to use instead of get_dxdy(lon,lat,relative) (e.g. a tile of a larger grid's spacing).
+   """
+   data=np.asarray(data)
+   if len(lon.shape)==1:
+     lon2,lat2=np.meshgrid(lon,lat)
+   else:
+     lon2,lat2=lon,lat
+ # Create spatial grid weights 
+   dx,dy=get_dxdy(lon,lat,relative=relative,dtype=dtype) if spacing is None else spacing
+   if type(dx) in [float,int]:
+     dx=dx*np.ones(lon2.shape,dtype=dtype)
+     dy=dy*np.ones(lon2.shape,dtype=dtype)
+   theta,magnitude,maxima=canny_maxima(data,sigma=sigma,dx=dx,dy=dy,dtype=dtype)
+   # canny compares magnitudes with thresholds divided by the input dtype's maximum
+   scale=dtype_limits(data,clip_negative=False)[1]
+   return {"theta":theta,"magnitude":magnitude,"maxima":maxima,"scale":scale,
+           "lon2":lon2,"lat2":lat2,"sigma":sigma,"dtype":np.dtype(dtype)}
+
+def edge_candidates(stage,theta_max=3.2,theta_min=-3.2,mag_min=0,spatial_mask=1):
+   """
+   The pointwise part of apply_edge_spec: returns (points, filt), the edge angles
+   above mag_min (NO_EDGE elsewhere) and the edge mask after the angle window and
+   spatial mask, before short edges are removed.
+   """
+   # canny with low_threshold == high_threshold: every candidate at or above the threshold
+   edges=stage["maxima"]&(stage["magnitude"]>=mag_min/stage["scale"])
+   points=np.where(edges,stage["theta"],NO_EDGE).astype(stage["theta"].dtype,copy=False)
+   filt=(points<theta_max)*(points>theta_min)*spatial_mask
+   return points,filt
+
+def apply_edge_spec(stage,theta_max=3.2,theta_min=-3.2,mag_min=0,minlen=1,spatial_mask=1):
+   """
+   Filter an edge_stage with one set of find_edge parameters (see find_edge).
+   Returns (points, filt): the edge angles above mag_min (NO_EDGE elsewhere),
+   and the edge mask after the angle window, spatial mask and minimum length,
+   exactly as find_edge computes them.
+   """
+   points,filt=edge_candidates(stage,theta_max=theta_max,theta_min=theta_min,mag_min=mag_min,spatial_mask=spatial_mask)
+   # filter out edges that are too short (8-connected within each slice, never across slices)
+   filt=remove_small(filt,minlen)
+   return points,filt
+
+def edge_sweep(data,lon,lat,sigma,specs,relative="Grid Cell",dtype=np.float64,validate=False,output="sparse",angles="float"):
+   """
+   find_edge for several parameter sets at once, sharing one canny stage.
+   Parameters
+   ----------
+   data, lon, lat, sigma, relative, dtype, validate :
+      as for find_edge
+   output : "sparse" or "points"
+      as for find_edge
+   angles : "float", "float16" or "int8"
+      as for find_edge
+   specs : dict
+      name -> dict of find_edge filter arguments (theta_max, theta_min,
+      mag_min, minlen, spatial_mask); missing ones take find_edge's defaults
+   Returns
+   -------
+   dict of name -> edge mask (or EdgePoints), identical to find_edge(..., output=output) with that spec
+   """
+   assert output in ['sparse','points']
+   stage=edge_stage(data,lon,lat,sigma,relative=relative,dtype=dtype)
+   out={}
+   for name,spec in specs.items():
+     points,filt=apply_edge_spec(stage,**spec)
+     out[name]=EdgePoints.from_mask(filt,lon,lat,angles=points,encoding=angles) if output=='points' else filt
+   if validate and np.dtype(dtype)!=np.float64:
+     ref=edge_sweep(data,lon,lat,sigma,specs,relative=relative,dtype=np.float64)
+     for name in specs:
+       new=out[name].to_dense() if output=='points' else out[name]
+       ndiff=((ref[name]!=0)!=(new!=0)).sum()
+       print(f"edge_sweep validation ({name}): {np.dtype(dtype)} edges differ from float64 at {ndiff} of {(ref[name]!=0).sum()} edge points")
+   return out
+
+def spec_grid(**params):
+   """
+   Every combination of the given filter parameters, as specs for edge_sweep.
+   Each argument is a list of values (or a single value, held fixed); the specs
+   are named by the tuple of swept values, in argument order, e.g.
+   spec_grid(mag_min=[0.002,0.003],minlen=[10,15],spatial_mask=mask)
+   has keys (0.002,10), (0.002,15), (0.003,10) and (0.003,15).
+   """
+   swept=[k for k,v in params.items() if isinstance(v,(list,tuple))]
+   fixed={k:v for k,v in params.items() if k not in swept}
+   specs={}
+   for values in itertools.product(*[params[k] for k in swept]):
+     specs[values]=dict(fixed,**dict(zip(swept,values)))
+   return specs
+
+
 #
 # size limits
 #
 
-def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1,minlen=1,spatial_mask=1,output='sparse',plotfreq=0,times=None,makefig=None,window=4):
+def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1,minlen=1,spatial_mask=1,output='sparse',plotfreq=0,times=None,makefig=None,window=4,dtype=np.float64):
    """
    Apply an ridge filter to 3D atmospheric fields (Designed for wind convergence but can be used elsewhere)
    Parameters
@@ -280,10 +347,11 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
       Minimum length of an ridge (in grid cells) for that edge to preserved
    spatial_mask : 2D boolean array or 1
       Masked location where edges will be sought
-   output : "sparse" or "lists"
+   output : "sparse", "points" or "lists"
       Controls output type. 
       If "sparse", returns a sparse boolean array with same shape as data,
                    containing 1s where ridge is detected
+      If "points", returns an edge_points.EdgePoints of the ridge pixels
       If "lists", returns 2 lists of lists, containing lat and lon cooordinates
                    of detected ridges for each day
    plotfreq : float between 0 and 1
@@ -299,6 +367,8 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
    window : integer
       number of grid-cells either side of each point to use when calculating eigenvectors of the
       inertial tensor (used to find ridge directions)
+   dtype : np.float64 or np.float32
+      precision of the smoothed field and returned angles
    """
    # Assertations that input shapes are correct
    assert(len(data.shape)>=2)
@@ -315,8 +385,8 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
    if type(spatial_mask) != int:
      assert(len(spatial_mask.shape)==2)
      assert(spatial_mask.shape==data[0].shape)
-   assert output in ['sparse','lists']
-   if output=='sparse':
+   assert output in ['sparse','points','lists']
+   if output in ['sparse','points']:
      gather = []
    elif output=='lists':
      gather=[],[]
@@ -328,6 +398,7 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
    vmax=max(data.max(),-data.min())
    # iterate through time
    for tt,d in zip(times,data):
+     d=np.asarray(d,dtype=dtype)
      if sigma == None:
        ds=d.copy()
      else:
@@ -337,12 +408,9 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
      # restrict to desired angles and locations
      filt=((points<theta_max)*(points>theta_min)*spatial_mask).filled(0)
      # filter out ridges that are too short
-     mask,n=label(filt,structure=np.ones((3,3),dtype=bool))
-     nmasked=np.array([(mask==j).sum() for j in range(n+1)])
-     nmasked[0]=0
-     filt = (nmasked[mask]>minlen)*filt
+     filt = remove_small(filt,minlen)
      # add to output array or lists
-     if output=='sparse':
+     if output in ['sparse','points']:
        gather.append(filt)
      if output=='lists':
         flat=filt.flatten()
@@ -367,5 +435,7 @@ def find_ridge(data,lon,lat,sigma,theta_max=3.2,theta_min=-3.2,mag_min=0,sign=-1
      plt.show()
    if output=='sparse':
      gather=np.array(gather)
+   elif output=='points':
+     gather=EdgePoints.from_mask(np.array(gather),lon,lat)
    return gather
 
@@ -0,0 +1,133 @@
+"""
+edge_points.py - sparse storage of detected edge pixels
+
+A (time, lat, lon) edge mask is mostly zeros. ``EdgePoints`` keeps only the
+edge pixels, per slice in compressed sparse row form, together with the grid's
+coordinates and optionally the edge angles, so counts, coordinates, latitude
+statistics and GeoJSON come straight from the points and memory scales with
+the number of edge pixels rather than the size of the cube.
+"""
+import numpy as np
+
+from canny_mod import decode_angles, encode_angles
+
+
+class EdgePoints:
+    """
+    Edge pixels of a (time, lat, lon) stack. The points of slice ``k`` are
+    ``index[indptr[k]:indptr[k + 1]]``, flat ``row*nx + col`` grid indices in
+    ascending (row-major) order; ``angle``, if present, holds their edge angles
+    in an ``encode_angles`` encoding. ``lon`` and ``lat`` are the grid
+    coordinates, 1D (per column / row) or 2D.
+    """
+
+    def __init__(self, indptr, index, shape, lon, lat, angle=None):
+        self.indptr = np.asarray(indptr, np.int64)
+        self.index = np.asarray(index)
+        self.shape = tuple(shape)
+        self.lon = np.asarray(lon)
+        self.lat = np.asarray(lat)
+        self.angle = angle
+        assert len(self.shape) == 3 and len(self.indptr) == self.shape[0] + 1
+
+    @classmethod
+    def from_mask(cls, mask, lon, lat, angles=None, encoding="float"):
+        """
+        Build from a dense edge mask (2D, or a stack of 2D slices; nonzero is an
+        edge), e.g. ``find_edge`` output. ``angles``, an array of the same shape
+        such as canny's angle output, is sampled at the edges and kept in ``encoding``.
+        """
+        mask = np.asarray(mask)
+        if mask.ndim == 2:
+            mask = mask[np.newaxis]
+        nt = mask.shape[0]
+        k, index = np.nonzero(mask.reshape(nt, -1))
+        indptr = np.zeros(nt + 1, np.int64)
+        np.cumsum(np.bincount(k, minlength=nt), out=indptr[1:])
+        # int32 indices are enough for any single 2D grid we handle
+        index = index.astype(np.int32 if mask[0].size < 2**31 else np.int64)
+        angle = None
+        if angles is not None:
+            angle = encode_angles(np.asarray(angles).reshape(nt, -1)[k, index], encoding)
+        return cls(indptr, index, mask.shape, lon, lat, angle)
+
+    @classmethod
+    def concat(cls, parts):
+        """Join EdgePoints of consecutive chunks of one series (same grid) along the time axis."""
+        parts = list(parts)
+        first = parts[0]
+        indptr = [np.zeros(1, np.int64)]
+        for part in parts:
+            assert part.shape[1:] == first.shape[1:]
+            indptr.append(part.indptr[1:] + indptr[-1][-1])
+        angle = None
+        if all(part.angle is not None for part in parts):
+            angle = np.concatenate([part.angle for part in parts])
+        shape = (sum(part.shape[0] for part in parts),) + first.shape[1:]
+        return cls(np.concatenate(indptr), np.concatenate([part.index for part in parts]), shape,
+                   first.lon, first.lat, angle)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def n_points(self):
+        """Total number of edge pixels."""
+        return len(self.index)
+
+    def counts(self):
+        """Number of edge pixels in each slice."""
+        return np.diff(self.indptr)
+
+    def _points(self, k):
+        """Index range of slice ``k``'s points, or of all points if ``k`` is None."""
+        return slice(None) if k is None else slice(self.indptr[k], self.indptr[k + 1])
+
+    def rows_cols(self, k=None):
+        """Grid row (lat) and column (lon) indices of the points of slice ``k`` (all slices if None)."""
+        return np.divmod(self.index[self._points(k)], self.shape[2])
+
+    def lon_lat(self, k=None):
+        """Longitudes and latitudes of the points of slice ``k`` (all slices if None)."""
+        if self.lon.ndim == 2:
+            index = self.index[self._points(k)]
+            return self.lon.ravel()[index], self.lat.ravel()[index]
+        rows, cols = self.rows_cols(k)
+        return self.lon[cols], self.lat[rows]
+
+    def angles(self, k=None):
+        """Edge angles (float32 radians) of the points of slice ``k`` (all slices if None)."""
+        if self.angle is None:
+            raise ValueError("these EdgePoints were built without angles")
+        return decode_angles(self.angle[self._points(k)])
+
+    def slice_ids(self):
+        """The slice each point belongs to."""
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def mean_lat(self):
+        """Mean latitude of each slice's edge pixels (NaN for slices without any)."""
+        _, lat = self.lon_lat()
+        total = np.bincount(self.slice_ids(), weights=lat, minlength=len(self))
+        counts = self.counts()
+        return np.divide(total, counts, out=np.full(len(self), np.nan), where=counts > 0)
+
+    def to_dense(self, k=None):
+        """Boolean mask of slice ``k``, or of the whole stack if None."""
+        if k is not None:
+            out = np.zeros(self.shape[1]*self.shape[2], bool)
+            out[self.index[self._points(k)]] = True
+            return out.reshape(self.shape[1:])
+        out = np.zeros((len(self), self.shape[1]*self.shape[2]), bool)
+        out[self.slice_ids(), self.index] = True
+        return out.reshape(self.shape)
+
+    def features(self, k=0, properties=None):
+        """GeoJSON Point features for the edge pixels of slice ``k``, each carrying ``properties``."""
+        lon, lat = self.lon_lat(k)
+        properties = properties or {}
+        return [{
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(x), float(y)]},
+            "properties": dict(properties),
+        } for x, y in zip(lon, lat)]
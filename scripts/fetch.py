@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+"""
+fetch.py - download engine for NOMADS GRIB files
+
+Downloads many files at once through a bounded thread pool. Each worker thread
+keeps its own keep-alive ``requests.Session`` so repeated requests to the same
+host reuse one TCP/TLS connection. Transient failures (connection errors,
+timeouts, 429 and 5xx responses) are retried with exponential backoff.
+
+By default only the GRIB messages a script needs are transferred: the ``.idx``
+inventory that sits next to every GRIB file on the NOMADS file server is read,
+and the wanted messages are fetched with HTTP Range requests and joined into one
+local GRIB file. Set NOMADS_FETCH=filter to go through the filter CGI instead.
+
+Messages are named as they appear in the inventory, ``"VAR:level"``, e.g.
+``"TMP:850 mb"`` or ``"SPFH:2 m above ground"``.
+
+``fetch_many`` yields each file as soon as it has arrived, so callers can start
+processing the first fields while the rest are still downloading.
+
+Downloads go through the local artifact cache (see artifacts.py), so re-runs
+and other scripts asking for the same data read it from disk. In "range" mode
+the inventory is cached per file, and each message is cached on its own under
+the file's URL path, its name and the digest of the inventory. A script that
+needs one variable therefore finds it in the cache after another script has
+fetched a superset, and a republished file never yields stale messages. Whole
+files (the filter CGI) are cached under their URL path and query. A cached
+inventory or file is revalidated with a conditional request (If-None-Match /
+If-Modified-Since) when the server sent an ETag or Last-Modified for it; a 304
+answer costs no transfer. Without validators the cached copy is used as is,
+since a published cycle does not change.
+
+Running this module directly starts an offline benchmark against a local HTTP
+stand-in for NOMADS (see ``serve``):
+
+    python scripts/fetch.py --files 220 --size 1500000 --latency 0.5 --workers 1 4 8 16
+"""
+import io
+import os
+import hashlib
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from artifacts import ARTIFACTS, ArtifactCache, artifact_key
+
+# ------------------------
+# Config
+# ------------------------
+NOMADS_URL = os.getenv("NOMADS_URL", "https://nomads.ncep.noaa.gov")
+# NOAA Open Data buckets holding the full GDAS/GEFS archive (NOMADS keeps about ten days)
+GDAS_ARCHIVE_URL = os.getenv("GDAS_ARCHIVE_URL", "https://noaa-gfs-bdp-pds.s3.amazonaws.com")
+GEFS_ARCHIVE_URL = os.getenv("GEFS_ARCHIVE_URL", "https://noaa-gefs-pds.s3.amazonaws.com")
+NOMADS_FETCH = os.getenv("NOMADS_FETCH", "range")  # "range" (.idx + HTTP Range) or "filter" (filter CGI)
+MAX_WORKERS = int(os.getenv("NOMADS_MAX_WORKERS", "8"))  # keep modest: NOMADS rate-limits per IP
+RETRIES = int(os.getenv("NOMADS_RETRIES", "4"))
+BACKOFF = float(os.getenv("NOMADS_BACKOFF", "2.0"))  # seconds, doubled on every retry
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Where each product lives on the NOMADS file server, which filter CGI serves it
+# and where the archive keeps it (the "atmos" layout, from March 2021 onwards)
+PRODUCTS = {
+    "gdas_0p25": {
+        "file": "/pub/data/nccf/com/gfs/prod/gdas.{date}/{cycle}/atmos/gdas.t{cycle}z.pgrb2.0p25.f{lead:03d}",
+        "filter": "/cgi-bin/filter_gdas_0p25.pl",
+        "dir": "/gdas.{date}/{cycle}/atmos",
+        "archive": (GDAS_ARCHIVE_URL, "/gdas.{date}/{cycle}/atmos/gdas.t{cycle}z.pgrb2.0p25.f{lead:03d}"),
+        "res": 0.25,
+    },
+    "gefs_0p50a": {
+        "file": "/pub/data/nccf/com/gens/prod/gefs.{date}/{cycle}/atmos/pgrb2ap5/{member}.t{cycle}z.pgrb2a.0p50.f{lead:03d}",
+        "filter": "/cgi-bin/filter_gefs_atmos_0p50a.pl",
+        "dir": "/gefs.{date}/{cycle}/atmos/pgrb2ap5",
+        "archive": (GEFS_ARCHIVE_URL, "/gefs.{date}/{cycle}/atmos/pgrb2ap5/{member}.t{cycle}z.pgrb2a.0p50.f{lead:03d}"),
+        "res": 0.5,
+    },
+}
+
+_local = threading.local()
+
+
+def get_session():
+    """Return this thread's keep-alive session, creating it on first use."""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def _with_retries(request, url, retries=RETRIES, backoff=BACKOFF):
+    """
+    Call ``request(session)`` until it succeeds, retrying transient failures with
+    exponential backoff. ``request`` should raise ``requests.HTTPError`` for bad
+    responses (e.g. via ``raise_for_status``).
+    """
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            return request(session)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as err:
+            status = getattr(err.response, "status_code", None)
+            if attempt == retries or (status is not None and status not in RETRY_STATUS):
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"Retrying {url} in {wait:.1f}s ({err})", file=sys.stderr)
+            time.sleep(wait)
+
+
+def _validators(response):
+    """ETag and Last-Modified of a response, for revalidating what it returned later."""
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+
+def _conditional(entry):
+    """If-None-Match / If-Modified-Since headers revalidating a cache ``entry`` (empty without validators)."""
+    headers = {}
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _url_key(url):
+    """Path and query of ``url``, which name the data whichever host serves it."""
+    return urlparse(url)._replace(scheme="", netloc="").geturl()
+
+
+def download(url, path, retries=RETRIES, backoff=BACKOFF, timeout=120, headers=None, validators=None):
+    """
+    Stream ``url`` to ``path``, retrying transient failures with exponential backoff.
+    The file is written to a ``.part`` sibling and renamed once complete, so a
+    half-written file is never mistaken for a finished download.
+    ``headers`` are sent with the request; if they make it conditional and the
+    server answers 304 Not Modified, ``path`` is left alone and None is returned.
+    The response's validators are put in the dict ``validators`` if one is given.
+    Raises ``requests.HTTPError`` for non-retryable responses or once retries run out.
+    """
+    path = Path(path)
+    part = path.with_name(path.name + ".part")
+
+    def request(session):
+        with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+            r.raise_for_status()
+            if validators is not None:
+                validators.update(_validators(r))
+            if r.status_code == 304:
+                return False
+            with open(part, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    if chunk:
+                        f.write(chunk)
+            return True
+
+    if not _with_retries(request, url, retries, backoff):
+        return None
+    part.replace(path)
+    return path
+
+
+# ------------------------
+# Byte-range retrieval from .idx inventories
+# ------------------------
+
+def parse_idx(text):
+    """
+    Parse a wgrib2-style inventory into a list of ``(start, end, "VAR:level")``
+    byte ranges. ``end`` is inclusive, or None for the last message in the file.
+    Inventory lines look like ``12:3456789:d=2025091000:TMP:850 mb:anl:``.
+    Submessages (``12.1:3456789:...``, ``12.2:3456789:...``, e.g. UGRD and
+    VGRD) share an offset and each map to the range of the whole message.
+    """
+    rows = []
+    for line in text.splitlines():
+        fields = line.split(":")
+        if len(fields) < 5:
+            continue
+        rows.append((int(fields[1]), f"{fields[3]}:{fields[4]}"))
+    rows.sort(key=lambda row: row[0])
+    offsets = sorted({start for start, _ in rows})
+    ends = dict(zip(offsets, [start - 1 for start in offsets[1:]] + [None]))
+    return [(start, ends[start], name) for start, name in rows]
+
+
+def select_ranges(inventory, messages):
+    """
+    Return the byte ranges holding ``messages``, with adjacent ranges joined so
+    that neighbouring messages are fetched in one request, and a range shared
+    by several submessages fetched once.
+    Raises ``KeyError`` if a requested message is not in the inventory.
+    """
+    wanted = set(messages)
+    picked = list(dict.fromkeys((start, end) for start, end, name in inventory if name in wanted))
+    missing = wanted - {name for _, _, name in inventory}
+    if missing:
+        raise KeyError(f"messages not in inventory: {sorted(missing)}")
+    merged = []
+    for start, end in picked:
+        if merged and merged[-1][1] is not None and merged[-1][1] + 1 == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_inventory(url, retries=RETRIES, backoff=BACKOFF, timeout=120, headers=None, validators=None):
+    """
+    Text of the ``url + ".idx"`` inventory of a GRIB file, or None if ``headers``
+    made the request conditional and the server answered 304 Not Modified. The
+    response's validators are put in the dict ``validators`` if one is given.
+    """
+    def get_idx(session):
+        r = session.get(url + ".idx", headers=headers, timeout=timeout)
+        r.raise_for_status()
+        if validators is not None:
+            validators.update(_validators(r))
+        return None if r.status_code == 304 else r.text
+
+    return _with_retries(get_idx, url + ".idx", retries, backoff)
+
+
+def get_messages(url, inventory, messages, retries=RETRIES, backoff=BACKOFF, timeout=120):
+    """
+    Bytes of each of ``messages`` of the GRIB file at ``url``, ``{name: bytes}``,
+    read with HTTP Range requests at the offsets of its parsed ``inventory``.
+    Neighbouring messages are fetched in one request and split afterwards.
+    """
+    wanted = set(messages)
+    chunks = {}
+    for start, end in select_ranges(inventory, messages):
+        byte_range = f"bytes={start}-" if end is None else f"bytes={start}-{end}"
+
+        def get_range(session):
+            r = session.get(url, headers={"Range": byte_range}, timeout=timeout)
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise requests.HTTPError(f"server ignored Range request for {url}", response=r)
+            return r.content
+
+        content = _with_retries(get_range, url, retries, backoff)
+        for first, last, name in inventory:
+            if name in wanted and start <= first and (end is None or first <= end):
+                chunk = content[first - start:None if last is None else last - start + 1]
+                chunks[name] = chunks.get(name, b"") + chunk
+    return chunks
+
+
+def _file_order(inventory, messages):
+    """
+    ``messages`` in inventory order, the order they are written to a file in,
+    leaving out those whose bytes an earlier one already holds (submessages of
+    one GRIB message, e.g. VGRD after UGRD).
+    """
+    wanted = set(messages)
+    starts = {}
+    for start, _, name in inventory:
+        if name in wanted:
+            starts.setdefault(name, set()).add(start)
+    missing = wanted - set(starts)
+    if missing:
+        raise KeyError(f"messages not in inventory: {sorted(missing)}")
+    names, written = [], set()
+    for name, offsets in starts.items():
+        if not offsets <= written:
+            names.append(name)
+            written |= offsets
+    return names
+
+
+def _write(path, chunks):
+    """Write ``chunks`` (bytes) to ``path`` through a ``.part`` sibling."""
+    path = Path(path)
+    part = path.with_name(path.name + ".part")
+    with open(part, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    part.replace(path)
+    return path
+
+
+def download_messages(url, path, messages, retries=RETRIES, backoff=BACKOFF, timeout=120):
+    """
+    Fetch only ``messages`` of the GRIB file at ``url`` into ``path`` using its
+    ``url + ".idx"`` inventory and HTTP Range requests.
+    """
+    inventory = parse_idx(get_inventory(url, retries, backoff, timeout))
+    names = _file_order(inventory, messages)
+    chunks = get_messages(url, inventory, names, retries, backoff, timeout)
+    return _write(path, (chunks[name] for name in names))
+
+
+def cached_inventory(url, cache=ARTIFACTS, retries=RETRIES, backoff=BACKOFF, timeout=120):
+    """Text of the inventory of the GRIB file at ``url``, from ``cache`` if it is still current."""
+    key = artifact_key("idx", url=_url_key(url))
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            cached = entry["path"].read_text()
+        except FileNotFoundError:
+            entry = None  # evicted meanwhile
+    validators = {}
+    if entry is not None:
+        headers = _conditional(entry)
+        if not headers:
+            return cached
+        text = get_inventory(url, retries, backoff, timeout, headers, validators)
+        if text is None:
+            cache.touch(key, **validators)
+            return cached
+    else:
+        text = get_inventory(url, retries, backoff, timeout, validators=validators)
+    cache.put_bytes(key, text.encode(), **validators)
+    return text
+
+
+def cached_messages(url, path, messages, cache=ARTIFACTS, retries=RETRIES, backoff=BACKOFF, timeout=120):
+    """``download_messages`` through ``cache``: only messages that are not cached are fetched."""
+    text = cached_inventory(url, cache, retries, backoff, timeout)
+    inventory = parse_idx(text)
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    names = _file_order(inventory, messages)
+    keys = {name: artifact_key("grib", url=_url_key(url), message=name, inventory=digest) for name in names}
+    chunks = {name: cache.read_bytes(key) for name, key in keys.items()}
+    missing = [name for name, chunk in chunks.items() if chunk is None]
+    if missing:
+        for name, chunk in get_messages(url, inventory, missing, retries, backoff, timeout).items():
+            cache.put_bytes(keys[name], chunk)
+            chunks[name] = chunk
+    return _write(path, (chunks[name] for name in names))
+
+
+def cached_download(url, path, cache=ARTIFACTS, **kwargs):
+    """``download`` through ``cache``."""
+    key = artifact_key("file", url=_url_key(url))
+    entry = cache.get(key)
+    validators = {}
+    if entry is not None:
+        headers = _conditional(entry)
+        if headers and download(url, path, headers=headers, validators=validators, **kwargs) is not None:
+            # changed on the server, and downloaded again
+            cache.put(key, path, **validators)
+            return Path(path)
+        if cache.materialise(entry, path):
+            cache.touch(key, **validators)
+            return Path(path)
+    download(url, path, validators=validators, **kwargs)
+    cache.put(key, path, **validators)
+    return Path(path)
+
+
+def grib_request(product, date, cycle, messages, member=None, lead=0, bbox=None, mode=None, archive=False):
+    """
+    Build the request for ``messages`` of one NOMADS GRIB file.
+    Returns ``(url, messages)`` for ``fetch``: in "range" mode the file-server URL
+    and the message list, in "filter" mode a filter CGI URL (the selection is in
+    the query string) and None.
+    ``bbox`` = (west, south, east, north) asks the filter CGI for that subregion only.
+    Whole GRIB messages are global, so in "range" mode the field has to be cropped
+    after decoding instead (see domain.crop).
+    ``archive=True`` asks the NOAA Open Data archive instead of NOMADS, for dates
+    NOMADS no longer holds; it keeps ``.idx`` inventories too but has no filter
+    CGI, so it is always read in "range" mode.
+    """
+    mode = mode or NOMADS_FETCH
+    spec = PRODUCTS[product]
+    fields = {"date": date, "cycle": cycle, "member": member, "lead": lead}
+    if archive:
+        base, path = spec["archive"]
+        return base + path.format(**fields), list(messages)
+    if mode == "range":
+        return NOMADS_URL + spec["file"].format(**fields), list(messages)
+    if mode != "filter":
+        raise ValueError(f"unknown NOMADS_FETCH mode {mode!r}")
+    name = Path(spec["file"].format(**fields)).name
+    variables = dict.fromkeys(m.split(":", 1)[0] for m in messages)
+    levels = dict.fromkeys(m.split(":", 1)[1].replace(" ", "_") for m in messages)
+    query = "&".join([f"var_{v}=on" for v in variables] + [f"lev_{l}=on" for l in levels])
+    if bbox is not None:
+        west, south, east, north = bbox
+        query += f"&subregion=&toplat={north}&leftlon={west}&rightlon={east}&bottomlat={south}"
+    url = (
+        f"{NOMADS_URL}{spec['filter']}"
+        f"?dir={spec['dir'].format(**fields).replace('/', '%2F')}"
+        f"&file={name}&{query}"
+    )
+    return url, None
+
+
+def fetch(url, path, messages=None, cache=ARTIFACTS, **kwargs):
+    """
+    Download a whole file, or only ``messages`` of a GRIB file when given, through
+    the artifact ``cache`` (ARTIFACT_CACHE_MB=0 turns the shared one off).
+    """
+    if not cache.enabled:
+        if messages:
+            return download_messages(url, path, messages, **kwargs)
+        return download(url, path, **kwargs)
+    if messages:
+        return cached_messages(url, path, messages, cache, **kwargs)
+    return cached_download(url, path, cache, **kwargs)
+
+
+def fetch_many(jobs, max_workers=MAX_WORKERS, skip_errors=False, **kwargs):
+    """
+    Download ``jobs`` concurrently and yield ``(key, path)`` in completion order.
+    Parameters
+    ----------
+    jobs : iterable of (key, url, path, messages)
+       ``key`` is any hashable label handed back with the finished path;
+       ``messages`` is a list of GRIB messages to range-fetch, or None for the whole file
+    max_workers : int
+       Maximum number of simultaneous requests
+    skip_errors : bool
+       yield ``(key, exception)`` for a failed download and carry on with the rest
+    kwargs :
+       passed on to ``fetch``
+    Otherwise, if any download fails the remaining queued downloads are cancelled
+    and the error is raised from the generator.
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {pool.submit(fetch, url, path, messages, **kwargs): key for key, url, path, messages in jobs}
+        for fut in as_completed(futures):
+            if skip_errors and fut.exception() is not None:
+                yield futures[fut], fut.exception()
+                continue
+            yield futures[fut], fut.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# ------------------------
+# Local NOMADS stand-in
+# ------------------------
+
+class _StandInHandler(SimpleHTTPRequestHandler):
+    """
+    Serve files from ``directory`` for both NOMADS URL styles: filter CGI
+    requests (``...pl?dir=...&file=NAME``) return ``directory/NAME`` and
+    file-server paths are resolved relative to ``directory``, falling back to
+    the bare file name so a flat directory of test files can stand in for the
+    whole tree. Single HTTP Range requests are honoured with 206 responses.
+    """
+    latency = 0.0
+
+    def translate_path(self, path):
+        query = parse_qs(urlparse(path).query)
+        if "file" in query:
+            path = "/" + query["file"][0]
+        local = super().translate_path(path)
+        if not os.path.exists(local):
+            local = super().translate_path("/" + urlparse(path).path.rsplit("/", 1)[-1])
+        return local
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        byte_range = self.headers.get("Range")
+        if not byte_range:
+            return super().send_head()
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        size = os.path.getsize(path)
+        start, _, end = byte_range.removeprefix("bytes=").partition("-")
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, port=0, latency=0.0):
+    """
+    Start a threaded local HTTP server for ``directory`` in a daemon thread.
+    ``latency`` adds a fixed delay (seconds) to every request to mimic the
+    round-trip time of the real server. Returns ``(server, base_url)``; call
+    ``server.shutdown()`` when finished. Point NOMADS_URL at ``base_url`` to run
+    the scripts against it.
+    """
+    handler = type("Handler", (_StandInHandler,), {"latency": latency})
+
+    def factory(*args, **kwargs):
+        return handler(*args, directory=str(directory), **kwargs)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), factory)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def benchmark(files=220, size=1_500_000, latency=0.5, workers=(1, 4, 8, 16)):
+    """Time ``fetch_many`` against the local stand-in for several concurrency limits."""
+    src = Path(tempfile.mkdtemp(prefix="nomads_src_"))
+    dst = Path(tempfile.mkdtemp(prefix="nomads_dst_"))
+    no_cache = ArtifactCache(max_bytes=0)  # every round has to hit the server
+    try:
+        payload = os.urandom(size)
+        for i in range(files):
+            (src / f"field{i:03d}.grib2").write_bytes(payload)
+        server, base = serve(src, latency=latency)
+        for n in workers:
+            jobs = [(i, f"{base}/cgi-bin/filter.pl?file=field{i:03d}.grib2", dst / f"field{i:03d}.grib2", None)
+                    for i in range(files)]
+            start = time.perf_counter()
+            for _ in fetch_many(jobs, max_workers=n, cache=no_cache):
+                pass
+            elapsed = time.perf_counter() - start
+            print(f"workers={n:3d}  {elapsed:7.2f} s  {files * size / elapsed / 1e6:8.1f} MB/s")
+        server.shutdown()
+    finally:
+        shutil.rmtree(src, ignore_errors=True)
+        shutil.rmtree(dst, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark fetch_many against a local NOMADS stand-in")
+    parser.add_argument("--files", type=int, default=220)
+    parser.add_argument("--size", type=int, default=1_500_000, help="bytes per file")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds added to every request")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+    benchmark(args.files, args.size, args.latency, args.workers)
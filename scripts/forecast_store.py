@@ -0,0 +1,177 @@
+"""
+forecast_store.py - archive of ensemble forecast metrics as a Parquet dataset
+
+Each forecast run is one (member, lead) table with a typed column per metric
+(rainbelt latitudes, CAB and KD grid-cell counts), written to its own
+partition ``<store>/init_date=YYYYMMDD/cycle=HH/``. A run adds a partition
+rather than overwriting the previous one, and re-running the same init date
+and cycle replaces just that partition, so the store is an archive of every
+forecast for verification. Reads prune partitions and columns, so one run, one
+lead or a few members come back without parsing the rest. ``export_csv``
+writes the old wide per-metric CSV layout from a run. The CAB and KD objects
+of a run, tracked along the leads, go to a second store laid out the same way
+(``write_tracks``).
+
+While a run is in progress its finished (member, lead) results are appended
+to a journal, one JSON line each, flushed as they are written. A re-run of the
+same init date and cycle reads the journal back and only fetches and analyses
+what is missing; a line cut short by a crash is ignored.
+"""
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+
+STORE_DIR = Path("database") / "forecast"
+TRACKS_DIR = Path("database") / "forecast_tracks"
+# per-run journals of finished (member, lead) results, so an interrupted run can resume
+JOURNAL_DIR = Path(os.getenv("FORECAST_JOURNAL_DIR", ".cache/forecast"))
+# metric columns and their types; counts are nullable so missing fields stay explicit
+METRICS = {"rain": "float64", "rain_north": "float64", "rain_south": "float64",
+           "cab": "Int32", "kd": "Int32"}
+PARTITIONING = pds.partitioning(pa.schema([("init_date", pa.string()), ("cycle", pa.string())]),
+                                flavor="hive")
+# legacy CSV file and column suffix of each metric (see export_csv)
+CSV_TABLES = {"rain": ("rainbelt_lat.csv", ""), "rain_north": ("rainbelt_lat_north.csv", ""),
+              "rain_south": ("rainbelt_lat_south.csv", ""), "cab": ("cab_gridcells.csv", "_cab_gridcells"),
+              "kd": ("kd_gridcells.csv", "_kd_gridcells")}
+
+
+def run_table(results, members, leads):
+    """
+    The (member, lead) table of one run, in member then lead order, from
+    ``results`` {(member, lead): {metric: value}}. Metrics missing from a
+    result, or results missing altogether, are NaN / null.
+    """
+    rows = [{"member": member, "lead": lead, **results.get((member, lead), {})}
+            for member in members for lead in leads]
+    frame = pd.DataFrame(rows, columns=["member", "lead"] + list(METRICS))
+    frame["lead"] = frame["lead"].astype("int16")
+    return frame.astype(METRICS)
+
+
+def run_path(init_date, cycle, store=STORE_DIR):
+    """Directory of the partition holding one run."""
+    return Path(store) / f"init_date={init_date}" / f"cycle={cycle}"
+
+
+def write_run(frame, init_date, cycle, store=STORE_DIR):
+    """
+    Store ``frame`` (from ``run_table``) as the run ``init_date`` (YYYYMMDD),
+    ``cycle`` ("00".."18"), replacing any earlier copy of the same run. The file
+    is written beside its final name and renamed, so readers never see half a run.
+    Returns the file written.
+    """
+    return _write_table(frame, run_path(init_date, cycle, store) / "part-0.parquet")
+
+
+def write_tracks(objects, summary, init_date, cycle, store=TRACKS_DIR):
+    """
+    Store one run's tracked objects (``tracking.track_objects`` output) and
+    its track summary as objects.parquet and tracks.parquet in the run's
+    partition of the tracks store, replacing any earlier copy like
+    ``write_run``. Returns the two files written.
+    """
+    out_dir = run_path(init_date, cycle, store)
+    return _write_table(objects, out_dir / "objects.parquet"), _write_table(summary, out_dir / "tracks.parquet")
+
+
+def _write_table(frame, out_path):
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f".{out_path.name}.tmp")
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _dataset(store):
+    return pds.dataset(store, format="parquet", partitioning=PARTITIONING)
+
+
+def read_forecasts(store=STORE_DIR, init_date=None, cycle=None, members=None, leads=None, metrics=None):
+    """
+    Forecast rows as a DataFrame with columns init_date, cycle, member, lead and
+    the requested ``metrics`` (default all). ``init_date``, ``cycle``, ``members``
+    and ``leads`` each take a value or a list of values to select; None keeps all.
+    """
+    if not Path(store).exists():
+        return pd.DataFrame(columns=["init_date", "cycle", "member", "lead"] + list(metrics or METRICS))
+    selection = None
+    for name, wanted in (("init_date", init_date), ("cycle", cycle), ("member", members), ("lead", leads)):
+        if wanted is None:
+            continue
+        expr = pds.field(name).isin(list(np.atleast_1d(wanted)))
+        selection = expr if selection is None else selection & expr
+    columns = ["init_date", "cycle", "member", "lead"] + list(metrics or METRICS)
+    table = _dataset(store).to_table(columns=columns, filter=selection)
+    frame = table.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype()}.get)
+    return frame.sort_values(["init_date", "cycle", "member", "lead"], ignore_index=True)
+
+
+def latest_run(store=STORE_DIR):
+    """(init_date, cycle) of the most recent run in the store, or None if it is empty."""
+    runs = sorted((p.parent.name.split("=", 1)[1], p.name.split("=", 1)[1])
+                  for p in Path(store).glob("init_date=*/cycle=*") if any(p.glob("*.parquet")))
+    return runs[-1] if runs else None
+
+
+def cube(frame, metric):
+    """One metric of a single run's rows as a member x lead table."""
+    return frame.pivot(index="member", columns="lead", values=metric)
+
+
+def export_csv(frame, out_dir="database"):
+    """Write one run's rows as the wide per-metric CSVs (one row per member, one column per lead)."""
+    for metric, (name, suffix) in CSV_TABLES.items():
+        table = cube(frame, metric)
+        table.columns = [f"lead_{lead:03d}{suffix}" for lead in table.columns]
+        table.index.name = "ensemble"
+        table.reset_index().to_csv(Path(out_dir) / name, index=False)
+
+
+def journal_path(init_date, cycle, journal_dir=JOURNAL_DIR):
+    return Path(journal_dir) / f"{init_date}{cycle}.jsonl"
+
+
+def _plain(value):
+    """JSON-serialisable scalar (NaN stays NaN)."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def read_journal(init_date, cycle, journal_dir=JOURNAL_DIR):
+    """Results journaled for one run, {(member, lead): {metric: value}}; empty if there are none."""
+    path = journal_path(init_date, cycle, journal_dir)
+    results = {}
+    if not path.exists():
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line of an interrupted run
+            results[(entry.pop("member"), entry.pop("lead"))] = entry
+    return results
+
+
+def append_journal(results, init_date, cycle, journal_dir=JOURNAL_DIR):
+    """Append finished results {(member, lead): {metric: value}} to the run's journal."""
+    path = journal_path(init_date, cycle, journal_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        # end a torn line left by an interrupted run so it stays the only lost entry
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        for (member, lead), result in results.items():
+            entry = {"member": member, "lead": lead, **{k: _plain(v) for k, v in result.items()}}
+            f.write((json.dumps(entry) + "\n").encode())
+        f.flush()
+        os.fsync(f.fileno())
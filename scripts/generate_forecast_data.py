@@ -4,30 +4,41 @@ import sys
 import json
 import datetime as dt
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import requests
 import numpy as np
 import xarray as xr
-import geopandas as gpd
-from shapely.geometry import Polygon, mapping
-from shapely.ops import unary_union
-from skimage import measure
+from shapely.geometry import mapping
 import rioxarray  # needed for .rio accessors
 import pandas as pd 
-from shapely.vectorized import contains
 
-from drylines import find_edge,find_ridge,dxdy,ddx,ddy
+import domain
+import smoothing
+from drylines import find_edge,find_ridge,edge_sweep,dxdy,ddx,ddy,EDGE_ANGLES,EDGE_DTYPE,EDGE_VALIDATE
+from artifacts import ARTIFACTS, file_digest, source_digest
+from contours import largest_region_polygon
+from domain import africa_bbox, crop, normalize_lon
+from fetch import fetch_many, grib_request, MAX_WORKERS, PRODUCTS
+from forecast_store import append_journal, export_csv, journal_path, read_journal, run_table, write_run, write_tracks
+from masks import get_masks
+from smoothing import rolling_mean
+from tiled_edges import edge_sweep_tiled, EDGE_TILE, EDGE_TILE_WORKERS
+from tracking import extract_objects, track_objects, track_summary, OBJECT_COLUMNS, TRACK_MAX_KM, TRACK_MIN_SIZE
 
 # ------------------------
 # Config
 # ------------------------
 CYCLE = os.getenv("GDAS_CYCLE", "00")  # "00","06","12","18"
-AFRICA_GEOJSON_URL = os.getenv(
-    "AFRICA_GEOJSON_URL",
-    "https://gist.githubusercontent.com/1310aditya/35b939f63d9bf7fbafb0ab28eb878388/raw/africa.json",
-)
+# Processes used to analyse downloaded fields; 1 keeps everything in this process
+ANALYSIS_WORKERS = int(os.getenv("FORECAST_WORKERS", os.cpu_count() or 1))
+# Fields analysed by the edge detectors, and journaled, together
+FORECAST_BATCH = int(os.getenv("FORECAST_BATCH", "44"))
+# FORECAST_CSV=1 also writes the run as the old wide per-metric CSVs in database/
+FORECAST_CSV = os.getenv("FORECAST_CSV", "0") == "1"
 TILES_DIR = Path("database")
 TILES_DIR.mkdir(parents=True, exist_ok=True)
+# source of the code that derives the humidity fields, part of their artifact cache key
+HUMIDITY_CODE = source_digest(sys.modules[__name__], domain, smoothing)
 
 def specific_humidity_simple(ds):
     """
@@ -57,172 +68,235 @@ def specific_humidity_simple(ds):
     return q
 
 
-table_rain = []
-table_rain_north = []
-table_rain_south = []
-table_cab = []
-table_kd = []
-
-for ensemble_n in ['gep01', 'gep02', 'gep03', 'gep04', 'gep05', 'gep06', 'gep07', 'gep08', 'gep09', 'gep10', 'gep11', 'gep12', 'gep13', 'gep14', 'gep15', 'gep16', 'gep17', 'gep18', 'gep19', 'gep20']:
-    row_rain = {'ensemble': ensemble_n}
-    row_rain_north = {'ensemble': ensemble_n}
-    row_rain_south = {'ensemble': ensemble_n}
-    row_cab = {'ensemble': ensemble_n}
-    row_kd = {'ensemble': ensemble_n}
-    for lead in [0, 24, 48, 72, 96, 120, 144, 168, 192, 216, 240]:
-        print(f"Downloading ensemble {ensemble_n} lead {lead}")
-        # ------------------------
-        # Build today's URL & download (no fallback)
-        # ------------------------
-        today_str = dt.datetime.utcnow().strftime("%Y%m%d")
-
-        url = (
-            "https://nomads.ncep.noaa.gov/cgi-bin/filter_gefs_atmos_0p50a.pl"
-            f"?dir=%2Fgefs.{today_str}%2F{CYCLE}%2Fatmos%2Fpgrb2ap5"
-            f"&file={ensemble_n}.t00z.pgrb2a.0p50.f{lead:03d}"
-            "&var_RH=on&var_TMP=on&lev_850_mb=on&"
-            "subregion=&toplat=90&leftlon=-180&rightlon=180&bottomlat=-90"
-        )
-        
-        grib_path = Path(f"gdas.t{CYCLE}z.{ensemble_n}.f{lead:03d}")
-
-        r = requests.get(url, stream=True, timeout=120)
-        if r.status_code != 200:
-            print(f"ERROR: fetch failed with HTTP {r.status_code}", file=sys.stderr)
-            sys.exit(1)
-        with open(grib_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1 << 20):
-                if chunk:
-                    f.write(chunk)
-        print(f"Saved {grib_path}")
-                        
-        # ------------------------
-        # Load Africa geometry
-        # ------------------------
-        afr = gpd.read_file(AFRICA_GEOJSON_URL)
-        if afr.crs is None:
-            afr.set_crs(4326, inplace=True)
-        africa_union = unary_union(afr.geometry)
-
-        # ------------------------
-        # Open GRIB and select variable
-        # ------------------------
-        ds = xr.open_dataset(
-            grib_path,
-            engine="cfgrib",
-            backend_kwargs={"filter_by_keys": {"typeOfLevel": "isobaricInhPa", "level": 850}},
-        )
-
-        da = specific_humidity_simple(ds)
-        da = da.rio.write_crs(4326).rio.set_spatial_dims(x_dim="longitude", y_dim="latitude")
-
-        # ------------------------
-        # Detect CAB
-        # ------------------------
-
-        # make the lon/lat grid
-        lat = da.latitude.values
-        lon = da.longitude.values
-        lon2, lat2 = np.meshgrid(lon, lat)
-
-        # build boolean mask: True inside Africa
-        mask_africa = contains(africa_union, lon2, lat2)
-
-        # Create masks for acceptable CAB and KD locations
-        mask_cab = mask_africa*(lon2<=30)*(lon2>=15)*(lat2<=0)*(lat2>=-18)
-        mask_tkd = mask_africa*(lon2<=30)*(lat2<=-12)
-        # mask_tkd = (lon2<=30)*(lat2<=-12)#*(1-landmask.mask)
-        q = da.values
-        # give q an arbitrary time dimension
-        q = q[np.newaxis,:,:]
-
-        #Find dryline CABs. See drylines.py for a description of the inputs
-        cab_q=find_edge(q,lon,lat,1,theta_min=-np.pi/4,theta_max=np.pi/6,mag_min=0.003,minlen=7,spatial_mask=mask_cab,relative="Grid Cell",output='sparse',plotfreq=0,times=None)
-        #Find dryline KDs. See drylines.py for a description of the inputs
-        kd_q=find_edge(q,lon,lat,1,theta_max=np.pi/2,theta_min=np.pi/6,mag_min=0.003,minlen=5,spatial_mask=mask_tkd,relative="Grid Cell",output='sparse',plotfreq=0,times=None)
-
-
-        # smooth data
-        da_smooth = da.rolling(
-            longitude=8,
-            latitude=8,
-            center=True,
-            min_periods=1
-        ).mean()
-
-        # ------------------------
-        # Clip to Africa
-        # ------------------------
-        da_clip = da_smooth.rio.clip([mapping(africa_union)], crs=afr.crs, drop=False)
-
-        # ------------------------
-        # Threshold -> largest contour polygon
-        # ------------------------
-        belt = da_clip > 0.01
-        for dim in ["time", "step", "valid_time"]:
-            if dim in belt.dims:
-                belt2d = belt.isel({dim: 0})
-                da2d = da_clip.isel({dim: 0})
-                break
-        else:
-            belt2d = belt
-            da2d = da_clip
-
-        arr = belt2d.values.astype(np.uint8)
-        contours = measure.find_contours(arr, level=0.5)
-
-        largest_polygon = None
-        max_area = 0.0
-        for contour in contours:
-            rows = np.clip(contour[:, 0].astype(int), 0, arr.shape[0] - 1)  # y
-            cols = np.clip(contour[:, 1].astype(int), 0, arr.shape[1] - 1)  # x
-            lats = da2d.latitude.values[rows]
-            lons = da2d.longitude.values[cols]
-            poly = Polygon(zip(lons, lats))
-            if poly.is_valid and poly.area > max_area:
-                max_area = poly.area
-                largest_polygon = poly
-
-        # fail if no polygon found
-        if largest_polygon is None:
-            print("No valid polygon found; exiting without changes.")
-            sys.exit(0)
-        # after (FAIL the job)
-        if largest_polygon is None:
-            raise SystemExit("No valid polygon found — aborting job.")
-
-        # add data to databases
-        row_rain[f"lead_{lead:03d}"] = largest_polygon.centroid.y
+ENSEMBLE = ['gep01', 'gep02', 'gep03', 'gep04', 'gep05', 'gep06', 'gep07', 'gep08', 'gep09', 'gep10', 'gep11', 'gep12', 'gep13', 'gep14', 'gep15', 'gep16', 'gep17', 'gep18', 'gep19', 'gep20']
+LEADS = [0, 24, 48, 72, 96, 120, 144, 168, 192, 216, 240]
+
+
+# GRIB messages needed from each member file
+MESSAGES = ["TMP:850 mb", "RH:850 mb"]
+
+
+def forecast_bbox():
+    """Africa plus a halo covering the 8x8 smoothing window and the sigma=1 edge detector."""
+    return africa_bbox(PRODUCTS["gefs_0p50a"]["res"], window=8, sigma=1)
+
+
+def humidity_fields(grib_path):
+    """Cropped 850 hPa specific humidity of one (member, lead) file, and its 8x8 running mean."""
+    # ------------------------
+    # Open GRIB and select variable
+    # ------------------------
+    ds = xr.open_dataset(
+        grib_path,
+        engine="cfgrib",
+        backend_kwargs={"filter_by_keys": {"typeOfLevel": "isobaricInhPa", "level": 850}},
+    )
+
+    da = specific_humidity_simple(ds)
+    # Normalize longitude and crop to Africa before any analysis
+    da = crop(normalize_lon(da), forecast_bbox())
+    da = da.rio.write_crs(4326).rio.set_spatial_dims(x_dim="longitude", y_dim="latitude").load()
+    ds.close()
+
+    # smooth data
+    return da, rolling_mean(da, 8)
+
+
+def process_field(grib_path):
+    """
+    Decode one downloaded (member, lead) file and run the rainbelt detector on it.
+    Returns the rainbelt results that go into the output tables and the cropped
+    specific humidity field, which ``detect_edges`` analyses with all the others.
+    The humidity fields are kept in the artifact cache under the file's digest.
+    """
+    da, da_smooth = ARTIFACTS.derived("gefs_q850", lambda: humidity_fields(grib_path), HUMIDITY_CODE,
+                                      grib=file_digest(grib_path), bbox=forecast_bbox(), window=8)
+
+    # Africa masks for this grid (built once, then read from the mask cache)
+    masks = get_masks(da.longitude.values, da.latitude.values)
+
+    # ------------------------
+    # Clip to Africa
+    # ------------------------
+    da_clip = da_smooth.where(masks["clip"])
+
+    # ------------------------
+    # Threshold -> largest contour polygon
+    # ------------------------
+    belt = da_clip > 0.01
+    for dim in ["time", "step", "valid_time"]:
+        if dim in belt.dims:
+            belt2d = belt.isel({dim: 0})
+            da2d = da_clip.isel({dim: 0})
+            break
+    else:
+        belt2d = belt
+        da2d = da_clip
+
+    # outline of the largest moist region (by pixel count), at sub-pixel precision
+    largest_polygon = largest_region_polygon(belt2d.values, da2d.longitude.values, da2d.latitude.values)
+
+    # no rainbelt in this field: its latitudes are missing, the field is still analysed for edges
+    if largest_polygon is None:
+        print(f"No valid polygon found in {grib_path}; rainbelt latitudes set to NaN.")
+        result = {"rain": np.nan, "rain_north": np.nan, "rain_south": np.nan}
+    else:
         coords = np.asarray(largest_polygon.exterior.coords)
         all_lat = coords[:, 1]  # take the latitude column
-        row_rain_north[f"lead_{lead:03d}"] = float(np.quantile(all_lat, 0.90))  # 90th
-        row_rain_south[f"lead_{lead:03d}"] = float(np.quantile(all_lat, 0.10))
-
-        row_cab[f"lead_{lead:03d}_cab_gridcells"] = np.nansum(cab_q)
-        row_kd[f"lead_{lead:03d}_kd_gridcells"] = np.nansum(kd_q)
-
-        # delete downloaded file
-        try:
-            ds.close()
-            os.remove(grib_path)
-            os.remove(grib_path.with_suffix('.idx'))
-        except:
-            continue
-    
-    table_rain.append(row_rain)
-    table_rain_north.append(row_rain_north)
-    table_rain_south.append(row_rain_south)
-    table_cab.append(row_cab)
-    table_kd.append(row_kd)
-
-table_rain = pd.DataFrame(table_rain)
-table_rain_north = pd.DataFrame(table_rain_north)
-table_rain_south = pd.DataFrame(table_rain_south)
-table_cab = pd.DataFrame(table_cab)
-table_kd = pd.DataFrame(table_kd)
-
-table_rain.to_csv("database/rainbelt_lat.csv", index=False)
-table_rain_north.to_csv("database/rainbelt_lat_north.csv", index=False)
-table_rain_south.to_csv("database/rainbelt_lat_south.csv", index=False)
-table_cab.to_csv("database/cab_gridcells.csv", index=False)
-table_kd.to_csv("database/kd_gridcells.csv", index=False)
+        result = {
+            "rain": largest_polygon.centroid.y,
+            "rain_north": float(np.quantile(all_lat, 0.90)),  # 90th
+            "rain_south": float(np.quantile(all_lat, 0.10)),
+        }
+
+    # delete downloaded file
+    try:
+        os.remove(grib_path)
+        os.remove(grib_path.with_suffix('.idx'))
+    except:
+        pass
+    return result, da
+
+
+def detect_edges(fields):
+    """
+    Count CAB and KD grid cells in every field at once, and list their objects.
+    ``fields`` maps (member, lead) to 2D specific humidity DataArrays on one grid;
+    the fields are stacked and each detector runs once over the whole stack.
+    Returns {(member, lead): {"cab": n, "kd": n, "cab_objects": [...], "kd_objects": [...]}},
+    each object a dict of the ``tracking.extract_objects`` columns from "label" on.
+    """
+    keys = list(fields)
+    lat = fields[keys[0]].latitude.values
+    lon = fields[keys[0]].longitude.values
+    masks = get_masks(lon, lat)
+    q = np.stack([fields[key].values for key in keys])
+
+    # Find dryline CABs and KDs, sharing one edge detection. See drylines.py for a description of the inputs
+    specs = {
+        "cab": dict(theta_min=-np.pi/4,theta_max=np.pi/6,mag_min=0.003,minlen=7,spatial_mask=masks["cab"]),
+        "kd": dict(theta_max=np.pi/2,theta_min=np.pi/6,mag_min=0.003,minlen=5,spatial_mask=masks["tkd"]),
+    }
+    if EDGE_TILE:
+        edges=edge_sweep_tiled(q,lon,lat,1,specs,relative="Grid Cell",dtype=EDGE_DTYPE,validate=EDGE_VALIDATE,tile=EDGE_TILE,workers=EDGE_TILE_WORKERS,output="points")
+    else:
+        edges=edge_sweep(q,lon,lat,1,specs,relative="Grid Cell",dtype=EDGE_DTYPE,validate=EDGE_VALIDATE,output="points",angles=EDGE_ANGLES)
+    cab_n,kd_n=edges["cab"].counts(),edges["kd"].counts()
+    objects = {}
+    for kind in specs:
+        frame = extract_objects(edges[kind], min_size=TRACK_MIN_SIZE)
+        objects[kind] = {k: group[OBJECT_COLUMNS[2:]].to_dict("records") for k, group in frame.groupby("step")}
+
+    return {key: {"cab": cab_n[k], "kd": kd_n[k],
+                  "cab_objects": objects["cab"].get(k, []), "kd_objects": objects["kd"].get(k, [])}
+            for k, key in enumerate(keys)}
+
+
+def lead_tracks(results):
+    """
+    Track each member's CAB and KD objects (from ``detect_edges`` results)
+    along the leads. Returns the objects, with "member", "kind", "track" and
+    "speed" (km/h) columns and the lead (hours) as step and time, and the
+    ``track_summary`` of their tracks.
+    """
+    rows = [{"member": member, "kind": kind, "step": lead, "time": lead, **obj}
+            for (member, lead), result in sorted(results.items())
+            for kind in ("cab", "kd") for obj in result.get(f"{kind}_objects", [])]
+    objects = pd.DataFrame(rows, columns=["member", "kind"] + OBJECT_COLUMNS)
+    objects = track_objects(objects, max_distance_km=TRACK_MAX_KM, by=["member", "kind"])
+    return objects, track_summary(objects, by=["member", "kind"])
+
+
+def main():
+    # ------------------------
+    # Download all (member, lead) files concurrently and decode each one as it lands.
+    # With FORECAST_WORKERS > 1 decoding and the rainbelt run in a process pool; workers
+    # send back the rainbelt results and the cropped field, so the output is identical
+    # to the serial path. The edge detectors run over stacks of FORECAST_BATCH fields,
+    # and each finished batch is journaled: a re-run for the same init date and cycle
+    # only fetches the fields that are not in the journal yet. A failed download or
+    # decode costs that one field, which is NaN in the output until a re-run fills it.
+    # The CAB and KD objects of every field are journaled with its counts and tracked
+    # along the leads of each member once all fields are in.
+    # ------------------------
+    today_str = dt.datetime.utcnow().strftime("%Y%m%d")
+    bbox = forecast_bbox()
+    results = read_journal(today_str, CYCLE)
+    jobs = []
+    for ensemble_n in ENSEMBLE:
+        for lead in LEADS:
+            if (ensemble_n, lead) in results:
+                continue
+            url, messages = grib_request("gefs_0p50a", today_str, CYCLE, MESSAGES,
+                                         member=ensemble_n, lead=lead, bbox=bbox)
+            jobs.append(((ensemble_n, lead), url, Path(f"gdas.t{CYCLE}z.{ensemble_n}.f{lead:03d}"), messages))
+    print(f"{len(results)} of {len(ENSEMBLE)*len(LEADS)} fields already in {journal_path(today_str, CYCLE)}")
+    print(f"Downloading {len(jobs)} files with up to {MAX_WORKERS} concurrent requests")
+    print(f"Analysing with {ANALYSIS_WORKERS} worker process(es)")
+
+    batch = {}
+    fields = {}
+    failed = []
+
+    def analysed(key, outcome):
+        """Queue one field's rainbelt result and field; run the edge detectors once a batch is full."""
+        batch[key], fields[key] = outcome
+        if len(fields) >= FORECAST_BATCH:
+            finish_batch()
+
+    def finish_batch():
+        """CAB and KD detection over the queued fields in one pass, then journal them."""
+        if not fields:
+            return
+        for key, counts in detect_edges(fields).items():
+            batch[key].update(counts)
+        append_journal(batch, today_str, CYCLE)
+        results.update(batch)
+        batch.clear()
+        fields.clear()
+
+    pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS) if ANALYSIS_WORKERS > 1 else None
+    try:
+        pending = {}
+        for key, grib_path in fetch_many(jobs, max_workers=MAX_WORKERS, skip_errors=True):
+            if isinstance(grib_path, Exception):
+                print(f"ERROR: fetch failed for {key}: {grib_path}", file=sys.stderr)
+                failed.append(key)
+                continue
+            print(f"Saved {grib_path}")
+            if pool is None:
+                try:
+                    analysed(key, process_field(grib_path))
+                except Exception as err:
+                    print(f"ERROR: analysis failed for {key}: {err!r}", file=sys.stderr)
+                    failed.append(key)
+            else:
+                pending[pool.submit(process_field, grib_path)] = key
+        if pool is not None:
+            for fut in as_completed(pending):
+                try:
+                    analysed(pending[fut], fut.result())
+                except Exception as err:
+                    print(f"ERROR: analysis failed for {pending[fut]}: {err!r}", file=sys.stderr)
+                    failed.append(pending[fut])
+        finish_batch()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    # one (member, lead) table per run, appended to the forecast store; missing fields are NaN
+    frame = run_table(results, ENSEMBLE, LEADS)
+    print(f"Wrote {write_run(frame, today_str, CYCLE)}")
+    objects, summary = lead_tracks(results)
+    print("Wrote " + " and ".join(map(str, write_tracks(objects, summary, today_str, CYCLE)))
+          + f" ({summary.shape[0]} tracks)")
+    if FORECAST_CSV:
+        export_csv(frame)
+    if failed:
+        print(f"ERROR: {len(failed)} field(s) missing, re-run to fetch them: "
+              + " ".join(f"{member}.f{lead:03d}" for member, lead in sorted(failed)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
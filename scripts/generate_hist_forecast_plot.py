@@ -7,12 +7,15 @@ import numpy as np
 from matplotlib.ticker import FuncFormatter
 from pathlib import Path
 
+from forecast_store import cube, latest_run, read_forecasts
+from history import read_history
+
 TILES_DIR = Path("assets/tracker")
 TILES_DIR.mkdir(parents=True, exist_ok=True)
 
-cab_history = pd.read_csv('database/cab_history.csv', parse_dates=['date'], index_col='date')
-heatlow_history = pd.read_csv('database/heatlow_history.csv', parse_dates=['date'], index_col='date')
-rainbelt_history = pd.read_csv('database/rainbelt_history.csv', parse_dates=['date'], index_col='date')
+cab_history = read_history('cab')
+heatlow_history = read_history('heatlow')
+rainbelt_history = read_history('rainbelt')
 
 most_recent_date = rainbelt_history.index.max()
 
@@ -174,51 +177,34 @@ forecast_start = most_recent_date + dt.timedelta(days=days_lag-1)
 import datetime as dt
 import numpy as np
 
-# --- Forecast plotting: Rainbelt mean lat ---
-rainbelt_future = pd.read_csv('database/rainbelt_lat.csv').T
-for i, col in enumerate(rainbelt_future.columns):
-    future_lats_series = pd.to_numeric(rainbelt_future[col], errors='coerce')
-    n_periods = len(future_lats_series)
-    future_dates = pd.date_range(start=forecast_start, periods=n_periods)
-    # compute compressed x positions as plain floats
-    future_x = np.array([date_to_compressed(d, most_recent_date, transition_days, compression_factor, forecast_days)
-                         for d in future_dates], dtype=float)
-    future_lats = future_lats_series.values.astype(float)
-    if i == 0:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, label='Rainbelt Forecast')
-    else:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, alpha=0.2)# label='Rainbelt Forecast')
-
-# --- Forecast plotting: Rainbelt south ---
-rainbelt_future = pd.read_csv('database/rainbelt_lat_south.csv').T
-for i, col in enumerate(rainbelt_future.columns):
-    future_lats_series = pd.to_numeric(rainbelt_future[col], errors='coerce')
-    n_periods = len(future_lats_series)
-    future_dates = pd.date_range(start=forecast_start, periods=n_periods)
+# latest run in the forecast store, one row per member and one column per lead
+forecast_metrics = ['rain', 'rain_south', 'rain_north']
+run = latest_run()
+if run is None:
+    # e.g. the first run after deployment: the history is still plotted
+    print("No forecast run in the store; plotting the history only.")
+    forecast_metrics = []
+else:
+    init_date, cycle = run
+    forecast = read_forecasts(init_date=init_date, cycle=cycle, metrics=forecast_metrics)
+
+# --- Forecast plotting: Rainbelt mean lat, south and north ---
+for metric in forecast_metrics:
+    rainbelt_future = cube(forecast, metric)
+    # lead 0 is plotted a day after forecast_start
+    future_dates = forecast_start + pd.to_timedelta(1 + rainbelt_future.columns/24, unit='D')
     # compute compressed x positions as plain floats
     future_x = np.array([date_to_compressed(d, most_recent_date, transition_days, compression_factor, forecast_days)
                          for d in future_dates], dtype=float)
-    future_lats = future_lats_series.values.astype(float)
-    if i == 0:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5)
-    else:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, alpha=0.2)# label='Rainbelt Forecast')
-
-# --- Forecast plotting: Rainbelt north ---
-rainbelt_future = pd.read_csv('database/rainbelt_lat_north.csv').T
-for i, col in enumerate(rainbelt_future.columns):
-    future_lats_series = pd.to_numeric(rainbelt_future[col], errors='coerce')
-    n_periods = len(future_lats_series)
-    future_dates = pd.date_range(start=forecast_start, periods=n_periods)
-    # compute compressed x positions as plain floats
-    future_x = np.array([date_to_compressed(d, most_recent_date, transition_days, compression_factor, forecast_days)
-                         for d in future_dates], dtype=float)
-    future_lats = future_lats_series.values.astype(float)
-    if i == 0:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5)
-    else:
-        ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, alpha=0.2)# label='Rainbelt Forecast')
-        
+    for i, (member, future_lats_series) in enumerate(rainbelt_future.iterrows()):
+        future_lats = future_lats_series.values.astype(float)
+        if i == 0 and metric == 'rain':
+            ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, label='Rainbelt Forecast')
+        elif i == 0:
+            ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5)
+        else:
+            ax.plot(future_x, future_lats, color='black', linestyle='-', lw=1.5, alpha=0.2)# label='Rainbelt Forecast')
+
 # --- Forecast plotting: CAB ---
 #cab_future = pd.read_csv('database/cab_gridcells.csv').T
 #cab_future_numeric = cab_future.apply(pd.to_numeric, errors='coerce')
@@ -0,0 +1,163 @@
+"""
+history.py - daily detector results in one SQLite database
+
+Each product (rainbelt, CAB, heat lows, convergence) has a table keyed by
+(date, cycle). A run's row is upserted through that primary-key index inside
+one immediate transaction, so re-running a date replaces its row without
+touching the rest of the history. Concurrent writers wait on SQLite's lock
+rather than overwriting each other's updates. ``export_csv`` writes the site's
+history CSVs (one row per date, without the cycle) from the database, and
+``read_history`` is the query API for plotting. A product's table is seeded
+from its CSV the first time it is used, and columns that appear in new rows,
+e.g. another heat-low region, are added to the table.
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DB_PATH = Path("database") / "history.sqlite"
+# history CSV of each product, written by export_csv
+HISTORIES = {"rainbelt": "rainbelt_history.csv", "cab": "cab_history.csv",
+             "heatlow": "heatlow_history.csv", "convergence": "convergence_history.csv"}
+CSV_CYCLE = "00"  # cycle of the rows seeded from the CSVs, which came from the 00Z runs
+TIMEOUT = 60  # seconds to wait for another writer's transaction
+
+
+def connect(db=DB_PATH):
+    """Connection in autocommit mode; transactions are opened explicitly."""
+    Path(db).parent.mkdir(parents=True, exist_ok=True)
+    return sqlite3.connect(db, timeout=TIMEOUT, isolation_level=None)
+
+
+@contextmanager
+def _transaction(con):
+    """Immediate (write-locking) transaction, rolled back if the block raises."""
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+
+def _sql_value(value):
+    """Python scalar for sqlite3, None for NaN."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _sql_type(value):
+    return "INTEGER" if isinstance(_sql_value(value), int) else "REAL"
+
+
+def _columns(con, product):
+    return [row[1] for row in con.execute(f'PRAGMA table_info("{product}")')]
+
+
+def _ensure_table(con, product, row=None):
+    """
+    Create ``product``'s table if needed (seeding it from its CSV) and add any
+    columns of ``row`` it lacks. Run inside a write transaction.
+    """
+    columns = _columns(con, product)
+    if not columns:
+        con.execute(f'CREATE TABLE "{product}" (date TEXT NOT NULL, cycle TEXT NOT NULL, '
+                    f'PRIMARY KEY (date, cycle))')
+        columns = ["date", "cycle"]
+        csv_path = Path("database") / HISTORIES[product]
+        if csv_path.exists():
+            seed = pd.read_csv(csv_path, dtype={"date": str})
+            rows = seed.to_dict("records")
+            if rows:
+                for name in seed.columns.drop("date"):
+                    con.execute(f'ALTER TABLE "{product}" ADD COLUMN "{name}" {_sql_type(rows[0][name])}')
+                _insert(con, product, rows, CSV_CYCLE)
+            columns = _columns(con, product)
+    for name, value in (row or {}).items():
+        if name not in columns:
+            con.execute(f'ALTER TABLE "{product}" ADD COLUMN "{name}" {_sql_type(value)}')
+
+
+def _insert(con, product, rows, cycle):
+    """Insert or replace the values of ``rows`` (dicts with a "date") for ``cycle``."""
+    values = [name for name in rows[0] if name != "date"]
+    columns = "".join(f', "{name}"' for name in values)
+    updates = ", ".join(f'"{name}" = excluded."{name}"' for name in values)
+    sql = (f'INSERT INTO "{product}" (date, cycle{columns}) VALUES (?, ?{", ?"*len(values)}) '
+           f'ON CONFLICT (date, cycle) DO UPDATE SET {updates}')
+    con.executemany(sql, ([str(row["date"]), cycle] + [_sql_value(row[n]) for n in values] for row in rows))
+
+
+def upsert(product, rows, cycle, db=DB_PATH):
+    """
+    Insert or update the row(s) of ``product`` for ``cycle``: ``rows`` is a dict
+    with a "date" (YYYYMMDD) and the product's values, or a list of such dicts
+    with the same keys (a bulk load). All rows are written in one transaction.
+    """
+    rows = [rows] if isinstance(rows, dict) else list(rows)
+    if not rows:
+        return
+    con = connect(db)
+    try:
+        with _transaction(con):
+            _ensure_table(con, product, rows[0])
+            _insert(con, product, rows, cycle)
+    finally:
+        con.close()
+
+
+def _query(product, cycle=None, start=None, end=None, db=DB_PATH):
+    """Rows of ``product`` (see ``read_history``) with dates as YYYYMMDD strings, sorted by date."""
+    con = connect(db)
+    try:
+        with _transaction(con):
+            _ensure_table(con, product)
+        if cycle is None:
+            # the latest cycle of each date
+            where = [f'cycle = (SELECT MAX(cycle) FROM "{product}" AS other WHERE other.date = "{product}".date)']
+            params = []
+        else:
+            where, params = ["cycle = ?"], [cycle]
+        if start is not None:
+            where.append("date >= ?")
+            params.append(str(start))
+        if end is not None:
+            where.append("date <= ?")
+            params.append(str(end))
+        frame = pd.read_sql_query(f'SELECT * FROM "{product}" WHERE {" AND ".join(where)} ORDER BY date',
+                                  con, params=params)
+    finally:
+        con.close()
+    return frame.drop(columns="cycle")
+
+
+def read_history(product, cycle=None, start=None, end=None, db=DB_PATH):
+    """
+    History of ``product`` as a DataFrame indexed by date (datetime), one row per
+    date: that of ``cycle``, or of each date's latest cycle if None. ``start``
+    and ``end`` (YYYYMMDD, inclusive) limit the dates.
+    """
+    frame = _query(product, cycle, start, end, db)
+    frame["date"] = pd.to_datetime(frame["date"], format="%Y%m%d")
+    return frame.set_index("date")
+
+
+def export_csv(product, path=None, db=DB_PATH):
+    """
+    Write ``product``'s history in its CSV layout (date column, one row per
+    date from its latest cycle) to ``path`` (default database/<HISTORIES entry>),
+    replacing the file atomically. Returns the path.
+    """
+    path = Path(path or Path("database") / HISTORIES[product])
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    _query(product, db=db).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
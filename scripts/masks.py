@@ -0,0 +1,115 @@
+"""
+masks.py - Africa geometry and gridded land/CAB/KD masks, cached on disk
+
+The Africa outline is read once per process. Masks are rasterised once per grid
+definition and stored under MASK_CACHE_DIR as bit-packed ``.npz`` files named by
+a hash of the grid coordinates, so later runs (and other scripts on the same
+grid) load them in milliseconds instead of re-running point-in-polygon tests.
+"""
+import os
+import hashlib
+import threading
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+import requests
+import geopandas as gpd
+import shapely
+from shapely.geometry import mapping
+from shapely.ops import unary_union
+from affine import Affine
+from rasterio import features
+
+# ------------------------
+# Config
+# ------------------------
+AFRICA_GEOJSON_URL = os.getenv(
+    "AFRICA_GEOJSON_URL",
+    "https://gist.githubusercontent.com/1310aditya/35b939f63d9bf7fbafb0ab28eb878388/raw/africa.json",
+)
+AFRICA_LOCAL_PATH = Path("africa.geojson")
+MASK_CACHE_DIR = Path(os.getenv("MASK_CACHE_DIR", ".cache/masks"))
+MASK_NAMES = ("africa", "clip", "cab", "tkd")
+# bump when the mask definitions below change so stale cache files are ignored
+MASK_VERSION = 1
+
+_masks = {}
+
+
+@lru_cache(maxsize=None)
+def load_africa():
+    """
+    Return the Africa outline as a single shapely geometry (EPSG:4326).
+    AFRICA_GEOJSON_URL may be a URL or a local file; URLs are downloaded once
+    to africa.geojson and read from disk afterwards.
+    """
+    source = AFRICA_GEOJSON_URL
+    if not Path(source).exists():
+        if not AFRICA_LOCAL_PATH.exists():
+            r = requests.get(source, timeout=30)
+            r.raise_for_status()
+            AFRICA_LOCAL_PATH.write_bytes(r.content)
+        source = AFRICA_LOCAL_PATH
+    afr = gpd.read_file(source)
+    if afr.crs is None:
+        afr = afr.set_crs(4326)
+    return unary_union(afr.geometry)
+
+
+def grid_hash(lon, lat):
+    """Short hash identifying a lon/lat grid (and the geometry/mask definitions used on it)."""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    h.update(b"|")
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    h.update(f"|{AFRICA_GEOJSON_URL}|v{MASK_VERSION}".encode())
+    return h.hexdigest()[:16]
+
+
+def build_masks(lon, lat):
+    """
+    Rasterise the Africa outline on a 1D lon/lat grid and derive the regions in
+    which CAB and Kalahari Discontinuity (KD) edges are accepted.
+    "africa" is a strict point-in-polygon test on grid points; "clip" is the
+    pixel-centre rasterisation that ``rio.clip`` uses, kept so clipped fields
+    match what the scripts produced with rioxarray.
+    """
+    africa_union = load_africa()
+    lon2, lat2 = np.meshgrid(lon, lat)
+    # True inside Africa
+    mask_africa = shapely.contains_xy(africa_union, lon2, lat2)
+    xres = float(lon[1] - lon[0])
+    yres = float(lat[1] - lat[0])
+    transform = Affine.translation(lon[0] - xres/2, lat[0] - yres/2) * Affine.scale(xres, yres)
+    mask_clip = features.geometry_mask([mapping(africa_union)], out_shape=lon2.shape,
+                                       transform=transform, invert=True)
+    # Create masks for acceptable CAB and KD locations
+    mask_cab = mask_africa*(lon2<=30)*(lon2>=15)*(lat2<=0)*(lat2>=-18)
+    mask_tkd = mask_africa*(lon2<=30)*(lat2<=-12)
+    return {"africa": mask_africa, "clip": mask_clip, "cab": mask_cab, "tkd": mask_tkd}
+
+
+def get_masks(lon, lat):
+    """
+    Return ``{"africa", "clip", "cab", "tkd"}`` boolean masks of shape (len(lat), len(lon)),
+    from memory, then the on-disk cache, building and saving them if needed.
+    """
+    key = grid_hash(lon, lat)
+    if key in _masks:
+        return _masks[key]
+    shape = (len(lat), len(lon))
+    path = MASK_CACHE_DIR / f"{key}.npz"
+    if path.exists():
+        packed = np.load(path)
+        masks = {name: np.unpackbits(packed[name], count=shape[0]*shape[1]).reshape(shape).astype(bool)
+                 for name in MASK_NAMES}
+    else:
+        masks = build_masks(lon, lat)
+        MASK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # write to a per-process, per-thread temporary name so concurrent workers never see a partial file
+        tmp = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp.npz")
+        np.savez(tmp, **{name: np.packbits(masks[name]) for name in MASK_NAMES})
+        tmp.replace(path)
+    _masks[key] = masks
+    return masks
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+process_convergence.py - 850 hPa wind-convergence lines over Africa
+
+Computes the divergence of the GDAS 850 hPa wind, smooths it and finds the
+ridges of convergence with find_ridge, then writes the lines as GeoJSON
+points (tiles/convergence.geojson) and their length, mean latitude and
+strength to database/convergence_history.csv, like the CAB product.
+"""
+import os
+import sys
+import json
+import datetime as dt
+from datetime import datetime
+from pathlib import Path
+
+import requests
+import numpy as np
+import xarray as xr
+
+from drylines import divergence, find_ridge
+from domain import africa_bbox, crop, halo_cells, normalize_lon
+from fetch import fetch, grib_request, PRODUCTS
+from history import export_csv, read_history, upsert
+from masks import get_masks
+
+# ------------------------
+# Config
+# ------------------------
+CYCLE = os.getenv("GDAS_CYCLE", "00")  # "00","06","12","18"
+TILES_DIR = Path("tiles")
+TILES_DIR.mkdir(parents=True, exist_ok=True)
+MESSAGES = ["UGRD:850 mb", "VGRD:850 mb"]
+SIGMA = 2  # smoothing of the divergence in grid cells
+RIDGE_WINDOW = 4  # half-width (grid cells) of the box that sets each ridge's direction
+CONV_MIN = 1e-5  # weakest convergence (s-1) on a convergence line
+MINLEN = 10  # shortest convergence line in grid cells
+# the divergence stencil, the smoothing and the ridge window all reach beyond a point
+WINDOW = 2*(halo_cells(sigma=SIGMA) + RIDGE_WINDOW)
+
+
+def detect(u, v, masks, today_str):
+    """
+    Find convergence lines in the 850 hPa wind ``u``, ``v`` (lon -180..180, Africa
+    domain). Returns the lines (EdgePoints) and the history row.
+    """
+    lat = u.latitude.values
+    lon = u.longitude.values
+    div = divergence(u.values, v.values, lon, lat)
+
+    # convergence lines are troughs of divergence (sign=-1); give div an arbitrary time dimension
+    lines = find_ridge(div[np.newaxis], lon, lat, SIGMA, mag_min=CONV_MIN, sign=-1, minlen=MINLEN,
+                       spatial_mask=masks["africa"], output='points', window=RIDGE_WINDOW)
+
+    rows, cols = lines.rows_cols(0)
+    conv_len = int(lines.counts()[0])
+    conv_lat = float(lines.mean_lat()[0])
+    # mean convergence along the lines, in 1e-5 s-1
+    conv_mean = float(-div[rows, cols].mean()*1e5) if conv_len else np.nan
+
+    row = {
+        "date": today_str,
+        "conv_len": conv_len,
+        "conv_lat": round(conv_lat, 4),
+        "conv_mean": round(conv_mean, 4),
+    }
+    return lines, row
+
+
+def run(u, v, masks, today_str, cycle=CYCLE):
+    """
+    Find convergence lines in the 850 hPa wind ``u``, ``v`` (lon -180..180, Africa
+    domain), write tiles/convergence.geojson and update database/convergence_history.csv.
+    """
+    lines, row = detect(u, v, masks, today_str)
+
+    # ------------------------
+    # Overwrite a single GeoJSON
+    # ------------------------
+    date_str = datetime.today().date().isoformat()
+    features = lines.features(0, {"source": "convergence", "date": date_str})
+    out_file = TILES_DIR / "convergence.geojson"
+    with open(out_file, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    print(f"Wrote {out_file} with {len(features)} points (date on each feature).")
+
+    # ------------------------
+    # Append convergence data to database/convergence_history.csv (idempotent per date and cycle)
+    # ------------------------
+    # upsert this date and cycle, then rewrite the CSV the site reads from the database
+    upsert("convergence", row, cycle)
+    history_path = export_csv("convergence")
+
+    print(f"Updated {history_path} for {row['date']}")
+
+    print(read_history("convergence"))
+    return True
+
+
+def main():
+    # ------------------------
+    # Build today's URL & download (no fallback)
+    # ------------------------
+    today_str = dt.datetime.utcnow().strftime("%Y%m%d")
+    bbox = africa_bbox(PRODUCTS["gdas_0p25"]["res"], window=WINDOW)
+    url, messages = grib_request("gdas_0p25", today_str, CYCLE, MESSAGES, bbox=bbox)
+    grib_path = Path(f"gdas.t{CYCLE}z.pgrb2.0p25.f000")
+
+    print(f"Downloading: {url}")
+    try:
+        fetch(url, grib_path, messages)
+    except (requests.RequestException, KeyError) as err:
+        print(f"ERROR: fetch failed: {err}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Saved {grib_path}")
+
+    # ------------------------
+    # Open GRIB and select the winds
+    # ------------------------
+    ds = xr.open_dataset(
+        grib_path,
+        engine="cfgrib",
+        backend_kwargs={"filter_by_keys": {"typeOfLevel": "isobaricInhPa", "level": 850}},
+    )
+    # adjust coords and crop to Africa (plus a halo for the derivatives, smoothing and ridge window)
+    u = crop(normalize_lon(ds["u"]), bbox)
+    v = crop(normalize_lon(ds["v"]), bbox)
+
+    masks = get_masks(u.longitude.values, u.latitude.values)
+    run(u, v, masks, today_str)
+
+
+if __name__ == "__main__":
+    main()
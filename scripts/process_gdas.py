@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+process_gdas.py - daily GDAS analysis: one download, one decode, four detectors
+
+Fetches the 850 hPa specific humidity, temperature and winds and the 2 m
+specific humidity of one GDAS cycle in a single request, decodes each level
+once, crops to Africa and builds the masks once, then runs the rainbelt,
+CAB/dryline, heat-low and convergence-line detectors side by side on the
+shared in-memory fields. Outputs are the same GeoJSON tiles, history database
+rows and history CSVs the four standalone scripts write. The decoded fields
+are kept in the artifact cache under the digest of the GRIB file, so a re-run
+on the same data skips the decode.
+"""
+import os
+import sys
+import datetime as dt
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import xarray as xr
+import rioxarray  # needed for .rio accessors
+
+import process_cab
+import process_convergence
+import process_heat_lows
+import process_rainbelt
+import domain
+from artifacts import ARTIFACTS, file_digest, source_digest
+from domain import africa_bbox, crop, normalize_lon
+from fetch import fetch, grib_request, PRODUCTS
+from masks import get_masks
+
+# ------------------------
+# Config
+# ------------------------
+CYCLE = os.getenv("GDAS_CYCLE", "00")  # "00","06","12","18"
+MESSAGES = (process_rainbelt.MESSAGES + process_heat_lows.MESSAGES + process_cab.MESSAGES
+            + process_convergence.MESSAGES)
+# one domain wide enough for the largest smoothing window and the edge detector's reach
+BBOX = africa_bbox(PRODUCTS["gdas_0p25"]["res"],
+                   window=max(process_rainbelt.WINDOW, process_heat_lows.WINDOW, process_convergence.WINDOW),
+                   sigma=process_cab.SIGMA)
+# source of the code that decodes the fields, part of their artifact cache key
+DECODE_CODE = source_digest(sys.modules[__name__], domain)
+
+
+def decode(grib_path):
+    """``{"q", "t", "u", "v", "sh2"}`` DataArrays of a GDAS file, cropped to BBOX (lon -180..180)."""
+    # cfgrib needs one dataset per level type
+    ds_850 = xr.open_dataset(
+        grib_path,
+        engine="cfgrib",
+        backend_kwargs={"filter_by_keys": {"typeOfLevel": "isobaricInhPa", "level": 850}},
+    )
+    ds_2m = xr.open_dataset(
+        grib_path,
+        engine="cfgrib",
+        backend_kwargs={"filter_by_keys": {"typeOfLevel": "heightAboveGround", "level": 2}},
+    )
+    fields = {}
+    for name, da in (("q", ds_850["q"]), ("t", ds_850["t"]), ("u", ds_850["u"]), ("v", ds_850["v"]),
+                     ("sh2", ds_2m["sh2"])):
+        da = crop(normalize_lon(da), BBOX).load()
+        fields[name] = da.rio.write_crs(4326).rio.set_spatial_dims(x_dim="longitude", y_dim="latitude")
+    ds_850.close()
+    ds_2m.close()
+    return fields
+
+
+def ingest(today_str, cycle=CYCLE, archive=False, grib_path=None):
+    """
+    Download and decode one GDAS cycle, from NOMADS or (``archive=True``) the NOAA
+    archive, into ``grib_path`` (default gdas.tCCz.pgrb2.0p25.f000 here).
+    Returns ``{"q", "t", "u", "v", "sh2"}`` DataArrays on the cropped Africa grid
+    (lon -180..180) and the masks for that grid.
+    """
+    url, messages = grib_request("gdas_0p25", today_str, cycle, MESSAGES, bbox=BBOX, archive=archive)
+    grib_path = Path(grib_path or f"gdas.t{cycle}z.pgrb2.0p25.f000")
+
+    print(f"Downloading: {url}")
+    fetch(url, grib_path, messages)
+    print(f"Saved {grib_path}")
+
+    fields = ARTIFACTS.derived("gdas_fields", lambda: decode(grib_path), DECODE_CODE,
+                               grib=file_digest(grib_path), bbox=BBOX)
+    masks = get_masks(fields["q"].longitude.values, fields["q"].latitude.values)
+    return fields, masks
+
+
+def main():
+    today_str = dt.datetime.utcnow().strftime("%Y%m%d")
+    try:
+        fields, masks = ingest(today_str)
+    except (requests.RequestException, KeyError) as err:
+        print(f"ERROR: fetch failed: {err}", file=sys.stderr)
+        sys.exit(1)
+
+    detectors = {
+        "rainbelt": lambda: process_rainbelt.run(fields["q"], masks, today_str, CYCLE),
+        "heat_lows": lambda: process_heat_lows.run(fields["t"], masks, today_str, CYCLE),
+        "cab": lambda: process_cab.run(fields["sh2"], masks, today_str, CYCLE),
+        "convergence": lambda: process_convergence.run(fields["u"], fields["v"], masks, today_str, CYCLE),
+    }
+    status = 0
+    # the detectors only read the shared fields and write disjoint outputs
+    with ThreadPoolExecutor(max_workers=len(detectors)) as pool:
+        futures = {name: pool.submit(detect) for name, detect in detectors.items()}
+        # let every detector finish so one failure does not cost the others their outputs
+        for name, future in futures.items():
+            try:
+                future.result()
+            except SystemExit as err:
+                print(f"ERROR: {name}: {err}", file=sys.stderr)
+                status = status or (err.code if isinstance(err.code, int) else 1)
+            except Exception as err:
+                print(f"ERROR: {name} failed: {err!r}", file=sys.stderr)
+                status = status or 1
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+regions.py - largest warm (or moist, ...) region in each of several latitude bands
+
+A band is a named range of latitudes with a quantile: the band's threshold is
+that quantile of the field over a reference range of latitudes (by default
+the band itself), and its region is the largest 8-connected component of the
+points above the threshold. All bands are labelled in one call, as the slices
+of a (band, lat, lon) stack, and sizes and means come from label histograms
+(``np.bincount``), so there is no per-region comparison of the whole label
+array and another band costs one slice more. Thresholds come from a partial
+sort (``np.partition``) of each band's values rather than a full sort. Only
+the largest region of each band is polygonised, inside its bounding box.
+"""
+import numpy as np
+from affine import Affine
+from rasterio import features
+from scipy.ndimage import find_objects
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from components import EIGHT_CONNECTED, label_components
+
+
+def band_rows(lat, lat_range):
+    """Rows of the 1D latitudes ``lat`` inside ``lat_range`` (lo, hi), both ends included."""
+    lo, hi = lat_range
+    return (lat >= lo) & (lat <= hi)
+
+
+def quantile(values, q):
+    """
+    ``np.nanquantile(values, q)`` (linear interpolation) from a partial sort of
+    the valid values; NaN if there are none.
+    """
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return np.nan
+    pos = q*(values.size - 1)
+    k = int(np.floor(pos))
+    kth = [k, k + 1] if k + 1 < values.size else [k]
+    part = np.partition(values, kth)
+    lower = float(part[k])
+    if len(kth) == 1:
+        return lower
+    return lower + (pos - k)*(float(part[k + 1]) - lower)
+
+
+def band_thresholds(values, lat, bands):
+    """
+    Threshold of each band of ``bands`` ({name: {"lat": (lo, hi), "quantile": q,
+    "reference": (lo, hi) or absent}}) over the 2D field ``values`` (lat, lon).
+    """
+    return {name: quantile(values[band_rows(lat, band.get("reference", band["lat"]))], band["quantile"])
+            for name, band in bands.items()}
+
+
+def largest_regions(values, lat, bands, thresholds, structure=EIGHT_CONNECTED):
+    """
+    The largest connected region above threshold in each band.
+    Parameters
+    ----------
+    values : 2D array (lat, lon)
+       field, NaN outside the domain
+    lat : 1D array
+       latitude of each row
+    bands : dict
+       {name: {"lat": (lo, hi), ...}}, see ``band_thresholds``
+    thresholds : dict
+       {name: threshold}
+    structure : 3x3 bool array
+       connectivity
+    Returns
+    -------
+    (labels, size, largest): the (band, lat, lon) label stack, the number of
+    points of each label, and {name: label of the band's largest region, or 0
+    if nothing in the band exceeds its threshold}
+    """
+    names = list(bands)
+    stack = np.zeros((len(names),) + values.shape, bool)
+    with np.errstate(invalid="ignore"):
+        for b, name in enumerate(names):
+            rows = band_rows(lat, bands[name]["lat"])
+            stack[b, rows] = values[rows] > thresholds[name]
+    labels, n = label_components(stack, structure)
+    size = np.bincount(labels.ravel(), minlength=n + 1)
+    size[0] = 0
+    # labels are numbered in scan order, so each slice holds a contiguous run of them
+    last = np.maximum.accumulate(labels.reshape(len(names), -1).max(axis=1))
+    first = np.concatenate([[1], last[:-1] + 1])
+    largest = {}
+    for b, name in enumerate(names):
+        if last[b] < first[b]:
+            largest[name] = 0
+        else:
+            largest[name] = int(first[b] + np.argmax(size[first[b]:last[b] + 1]))
+    return labels, size, largest
+
+
+def region_polygon(region, box, lon, lat, tolerance=0.0):
+    """
+    Polygon (lon/lat) of the grid cells of ``region``, a boolean array over the
+    (row, col) slices ``box`` of a regular grid with 1D coordinates ``lon``,
+    ``lat``, simplified with ``tolerance`` grid cells (0 keeps every cell corner).
+    """
+    xres = float(lon[1] - lon[0])
+    yres = float(lat[1] - lat[0])  # note: likely negative (north->south)
+    x0 = lon[box[1].start] - xres/2
+    y0 = lat[box[0].start] - yres/2
+    transform = Affine.translation(x0, y0)*Affine.scale(xres, yres)
+    shapes = features.shapes(region.astype(np.uint8), mask=region, transform=transform)
+    polygon = unary_union([shape(geom) for geom, val in shapes if val == 1])
+    if tolerance > 0:
+        polygon = polygon.simplify(tolerance*min(abs(xres), abs(yres)), preserve_topology=True)
+    return polygon
+
+
+def extract_regions(values, lon, lat, bands, tolerance=0.0, structure=EIGHT_CONNECTED):
+    """
+    Largest region above threshold in each latitude band of a 2D field.
+    Parameters
+    ----------
+    values : 2D array (lat, lon)
+       field on a regular grid, NaN outside the domain
+    lon, lat : 1D arrays
+       grid coordinates
+    bands : dict
+       {name: {"lat": (lo, hi), "quantile": q, "reference": (lo, hi)}}; the
+       threshold is the q quantile over the "reference" latitudes (default
+       "lat") and the region is searched for within "lat"
+    tolerance : float
+       polygon simplification in grid cells
+    structure : 3x3 bool array
+       connectivity
+    Returns
+    -------
+    {name: dict or None}: None if nothing in the band exceeds its threshold,
+    otherwise "polygon" (shapely, lon/lat), "threshold", "size" (grid cells),
+    "mean" (mean of ``values`` over the region), "lon" and "lat" (mean of the
+    region's cell centres, the centroid of the unsimplified polygon)
+    """
+    values = np.asarray(values)
+    lon, lat = np.asarray(lon), np.asarray(lat)
+    thresholds = band_thresholds(values, lat, bands)
+    labels, size, largest = largest_regions(values, lat, bands, thresholds, structure)
+    flat = labels.ravel()
+    n = len(size) - 1
+
+    def total(weights):
+        return np.bincount(flat, weights=np.broadcast_to(weights, labels.shape).ravel(), minlength=n + 1)
+
+    wanted = [lab for lab in largest.values() if lab > 0]
+    if wanted:
+        # background points may be NaN; they only add to label 0
+        sums = total(values)
+        lon_sums = total(lon[np.newaxis, :])
+        lat_sums = total(lat[:, np.newaxis])
+        boxes = find_objects(labels, max_label=n)
+    out = {}
+    for b, (name, lab) in enumerate(largest.items()):
+        if lab == 0:
+            out[name] = None
+            continue
+        box = boxes[lab - 1][1:]
+        region = labels[b][box] == lab
+        out[name] = {
+            "polygon": region_polygon(region, box, lon, lat, tolerance),
+            "threshold": thresholds[name],
+            "size": int(size[lab]),
+            "mean": float(sums[lab]/size[lab]),
+            "lon": float(lon_sums[lab]/size[lab]),
+            "lat": float(lat_sums[lab]/size[lab]),
+        }
+    return out
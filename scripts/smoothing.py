@@ -0,0 +1,69 @@
+"""
+smoothing.py - centred box means from summed-area tables
+
+Replaces ``da.rolling(latitude=w, longitude=w, center=True, min_periods=1).mean()``.
+Box sums come from cumulative sums along each smoothed axis (a summed-area
+table), so each output point costs the same whatever the window size, and
+leading dimensions (time, ensemble member) are smoothed in the same call.
+Missing data and the array edges are handled the way xarray's ``min_periods=1``
+handles them: the sum of the valid values in the window is divided by the
+number of valid values, and points whose window holds none are NaN.
+"""
+import numpy as np
+
+
+def window_bounds(n, window):
+    """
+    Start and (exclusive) stop of the centred window at each of ``n`` points,
+    clipped to the array: xarray's ``center=True`` puts point i in the window
+    ``i - window//2 .. i - window//2 + window - 1``.
+    """
+    start = np.arange(n) - window//2
+    return np.clip(start, 0, n), np.clip(start + window, 0, n)
+
+
+def _box_sum(values, axis, window):
+    """Sum of ``values`` over a centred window along ``axis``, from one cumulative sum."""
+    n = values.shape[axis]
+    start, stop = window_bounds(n, window)
+    shape = list(values.shape)
+    shape[axis] = n + 1
+    table = np.zeros(shape, values.dtype)
+    index = [slice(None)]*values.ndim
+    index[axis] = slice(1, None)
+    np.cumsum(values, axis=axis, out=table[tuple(index)])
+    return np.take(table, stop, axis=axis) - np.take(table, start, axis=axis)
+
+
+def box_mean(values, window, axes=(-2, -1)):
+    """
+    Centred moving mean of ``values`` over ``window`` points along each of ``axes``
+    (an int applies to all of them), ignoring NaNs and NaN where a window holds
+    no valid values. Sums are accumulated in float64, around the mean of the
+    data so long cumulative sums keep their precision; the result has the
+    input's floating dtype.
+    """
+    values = np.asarray(values)
+    dtype = np.result_type(values.dtype, np.float32)
+    axes = [axis % values.ndim for axis in np.atleast_1d(axes)]
+    windows = np.broadcast_to(window, (len(axes),))
+    valid = ~np.isnan(values)
+    offset = values[valid].mean() if valid.any() else 0.0
+    sums = np.where(valid, values - offset, 0.0).astype(np.float64)
+    counts = valid.astype(np.float64)
+    for axis, w in zip(axes, windows):
+        sums = _box_sum(sums, axis, int(w))
+        counts = _box_sum(counts, axis, int(w))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums/counts + offset
+    mean[counts == 0] = np.nan
+    return mean.astype(dtype, copy=False)
+
+
+def rolling_mean(da, window, dims=("latitude", "longitude")):
+    """
+    ``da.rolling({dim: window for dim in dims}, center=True, min_periods=1).mean()``
+    for a DataArray, computed with ``box_mean``; other dimensions are kept as they are.
+    """
+    axes = [da.get_axis_num(dim) for dim in dims]
+    return da.copy(data=box_mean(da.values, window, axes=axes))
@@ -0,0 +1,207 @@
+"""
+tiled_edges.py - find_edge / edge_sweep over grids too large to process whole
+
+The grid is cut into tiles whose cores partition it. Each tile is processed
+with a halo of ``domain.halo_cells(sigma=sigma)`` cells (the Gaussian's reach
+plus the gradient and non-maximum-suppression stencils), so every core point
+sees the neighbourhood it has in the whole grid and the edge candidates in the
+cores equal find_edge's exactly. Only one tile's floating-point temporaries
+exist at a time per worker; what is kept for the whole grid is the candidate
+mask of each spec and one int32 label array.
+
+Candidates are labelled tile by tile. Components that touch across a tile seam
+(8-connected, within a slice) are joined through a graph of label pairs before
+the minimum-length filter, so an edge crossing seams is measured whole.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from components import label_components
+from domain import halo_cells
+from drylines import edge_candidates, edge_stage, edge_sweep, get_dxdy
+from edge_points import EdgePoints
+
+# ------------------------
+# Config
+# ------------------------
+# core tile size in grid cells for the scripts' edge detection; 0 runs on the whole grid
+EDGE_TILE = int(os.getenv("EDGE_TILE", "0"))
+EDGE_TILE_WORKERS = int(os.getenv("EDGE_TILE_WORKERS", "1"))
+
+
+def tile_bounds(n, tile, halo):
+    """
+    Split ``range(n)`` into cores of ``tile`` points. Returns a list of
+    ``(core, outer)`` slices, ``outer`` being the core grown by ``halo`` on
+    each side and clipped to ``0..n``.
+    """
+    bounds = []
+    for start in range(0, n, tile):
+        stop = min(start + tile, n)
+        bounds.append((slice(start, stop), slice(max(start - halo, 0), min(stop + halo, n))))
+    return bounds
+
+
+def _inner(core, outer):
+    """Position of ``core`` within ``outer``."""
+    return slice(core.start - outer.start, core.stop - outer.start)
+
+
+def _cut(a, ys, xs):
+    """The (ys, xs) window of a 2D array; scalars (e.g. ``spatial_mask=1``) pass through."""
+    return a[ys, xs] if np.ndim(a) == 2 else a
+
+
+def _tile_candidates(block, lon, lat, spacing, sigma, specs, dtype):
+    """Edge candidates of every spec in one tile (a worker task); arguments are already cut to the tile."""
+    stage = edge_stage(block, lon, lat, sigma, dtype=dtype, spacing=spacing)
+    return {name: edge_candidates(stage, **spec)[1] for name, spec in specs.items()}
+
+
+def _pairs(a, b):
+    """
+    Label pairs that touch across a seam: ``a`` and ``b`` are the label lines
+    either side of it (seam along the last axis), 8-connected so each point of
+    ``a`` meets three points of ``b``.
+    """
+    n = a.shape[-1]
+    first, second = [], []
+    for shift in (-1, 0, 1):
+        pa = a[..., max(-shift, 0):n - max(shift, 0)]
+        pb = b[..., max(shift, 0):n - max(-shift, 0)]
+        touch = (pa > 0) & (pb > 0)
+        first.append(pa[touch])
+        second.append(pb[touch])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def remove_small_tiled(mask, minlen, row_cores, col_cores):
+    """
+    ``components.remove_small`` for a mask labelled tile by tile: components are
+    labelled within each (row_core, col_core) tile, joined across seams, and
+    zeroed if they have ``minlen`` points or fewer. Keeps mask's dtype.
+    """
+    labels = np.zeros(mask.shape, np.int32)
+    n = 0
+    for ys in row_cores:
+        for xs in col_cores:
+            lab, count = label_components(mask[..., ys, xs])
+            lab[lab > 0] += n
+            labels[..., ys, xs] = lab
+            n += count
+    size = np.bincount(labels.ravel(), minlength=n + 1)
+    size[0] = 0
+
+    # components meeting across row seams, then across column seams
+    first, second = [np.zeros(0, np.int32)], [np.zeros(0, np.int32)]
+    for ys in row_cores[1:]:
+        a, b = _pairs(labels[..., ys.start - 1, :], labels[..., ys.start, :])
+        first.append(a)
+        second.append(b)
+    for xs in col_cores[1:]:
+        a, b = _pairs(labels[..., :, xs.start - 1], labels[..., :, xs.start])
+        first.append(a)
+        second.append(b)
+    first, second = np.concatenate(first), np.concatenate(second)
+    graph = coo_matrix((np.ones(len(first), np.int8), (first, second)), shape=(n + 1, n + 1))
+    _, component = connected_components(graph, directed=False)
+    total = np.bincount(component, weights=size)
+    return (total[component][labels] > minlen)*mask
+
+
+def edge_sweep_tiled(data, lon, lat, sigma, specs, relative="Grid Cell", dtype=np.float64,
+                     validate=False, tile=256, workers=1, output="sparse"):
+    """
+    ``drylines.edge_sweep`` computed tile by tile, with the same result.
+    Parameters
+    ----------
+    data : array-like (time, lat, lon)
+       field to detect edges in; only one tile (plus halo) is read at a time,
+       so a lazily loaded array (netCDF variable, memmap, xarray) is never read whole
+    lon, lat, sigma, specs, relative, dtype :
+       as for ``edge_sweep``
+    validate : bool
+       report how the tiled edges differ from ``edge_sweep`` on the whole grid at
+       ``dtype`` and, if ``dtype`` is not float64, from the float64 whole-grid
+       edges (``edge_sweep(validate=True)``'s check)
+    tile : int
+       core tile size in grid cells (each tile is processed with a halo on top)
+    workers : int
+       number of processes working on tiles; 1 processes them in turn in this process
+    output : "sparse" or "points"
+       dense edge masks, or ``EdgePoints`` (without angles)
+    Returns
+    -------
+    dict of name -> edge mask or EdgePoints
+    """
+    ny, nx = data.shape[-2:]
+    halo = halo_cells(sigma=sigma)
+    # spacing of the whole grid ("Weighted Grid Cell" normalises by its mean); "Grid Cell" stays scalar
+    dx, dy = get_dxdy(lon, lat, relative=relative, dtype=dtype)
+    rows, cols = tile_bounds(ny, tile, halo), tile_bounds(nx, tile, halo)
+
+    def task(yout, xout):
+        tile_lon = lon[xout] if lon.ndim == 1 else lon[yout, xout]
+        tile_lat = lat[yout] if lat.ndim == 1 else lat[yout, xout]
+        tile_specs = {name: {k: _cut(v, yout, xout) for k, v in spec.items() if k != "minlen"}
+                      for name, spec in specs.items()}
+        return (np.asarray(data[..., yout, xout]), tile_lon, tile_lat,
+                (_cut(dx, yout, xout), _cut(dy, yout, xout)), sigma, tile_specs, dtype)
+
+    tiles = [(ycore, yout, xcore, xout) for ycore, yout in rows for xcore, xout in cols]
+    candidates = {}
+
+    def store(ycore, yout, xcore, xout, result):
+        for name, filt in result.items():
+            if name not in candidates:
+                candidates[name] = np.zeros(data.shape, filt.dtype)
+            candidates[name][..., ycore, xcore] = filt[..., _inner(ycore, yout), _inner(xcore, xout)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # keep a couple of tiles per worker in flight so inputs are not all copied at once
+            pending = []
+            for ycore, yout, xcore, xout in tiles:
+                pending.append(((ycore, yout, xcore, xout), pool.submit(_tile_candidates, *task(yout, xout))))
+                if len(pending) >= 2*workers:
+                    bounds, future = pending.pop(0)
+                    store(*bounds, future.result())
+            for bounds, future in pending:
+                store(*bounds, future.result())
+    else:
+        for ycore, yout, xcore, xout in tiles:
+            store(ycore, yout, xcore, xout, _tile_candidates(*task(yout, xout)))
+
+    row_cores = [core for core, _ in rows]
+    col_cores = [core for core, _ in cols]
+    out = {name: remove_small_tiled(candidates.pop(name), spec.get("minlen", 1), row_cores, col_cores)
+           for name, spec in specs.items()}
+    if validate:
+        whole = np.asarray(data)
+        ref = edge_sweep(whole, lon, lat, sigma, specs, relative=relative, dtype=dtype)
+        for name in specs:
+            ndiff = ((ref[name] != 0) != (out[name] != 0)).sum()
+            print(f"edge_sweep_tiled validation ({name}): tiled edges differ from whole-grid at "
+                  f"{ndiff} of {(ref[name] != 0).sum()} edge points")
+        if np.dtype(dtype) != np.float64:
+            ref = edge_sweep(whole, lon, lat, sigma, specs, relative=relative, dtype=np.float64)
+            for name in specs:
+                ndiff = ((ref[name] != 0) != (out[name] != 0)).sum()
+                print(f"edge_sweep_tiled validation ({name}): tiled {np.dtype(dtype)} edges differ from "
+                      f"whole-grid float64 at {ndiff} of {(ref[name] != 0).sum()} edge points")
+    if output == "points":
+        out = {name: EdgePoints.from_mask(out[name], lon, lat) for name in specs}
+    return out
+
+
+def find_edge_tiled(data, lon, lat, sigma, theta_max=3.2, theta_min=-3.2, mag_min=0, minlen=1,
+                    spatial_mask=1, relative="Grid Cell", dtype=np.float64, tile=256, workers=1):
+    """``drylines.find_edge(..., output='sparse')`` computed tile by tile; see ``edge_sweep_tiled``."""
+    spec = dict(theta_max=theta_max, theta_min=theta_min, mag_min=mag_min, minlen=minlen,
+                spatial_mask=spatial_mask)
+    return edge_sweep_tiled(data, lon, lat, sigma, {"edge": spec}, relative=relative, dtype=dtype,
+                            tile=tile, workers=workers)["edge"]
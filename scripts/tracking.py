@@ -0,0 +1,251 @@
+"""
+tracking.py - follow edge objects (CABs, KDs, drylines) through time
+
+Each slice of an edge mask is split into 8-connected components, and each
+component becomes an object with a centroid, length (grid cells) and
+orientation (``components.component_stats``) and a lon/lat bounding box.
+Boxes are in degrees rather than grid indices, so objects stored on disk
+still compare with those of a later run on a differently cropped grid.
+Objects are linked from one time to the next: candidate pairs come from a
+KD-tree of the centroids (a radius search, so the work grows with the number
+of nearby pairs rather than all pairs), each pair is scored by the overlap of
+the two objects' bounding boxes grown by a margin, and pairs are accepted
+greedily, best first, one-to-one. Linked objects share a track ID; from the tracks come lifetimes
+and propagation speeds.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from components import component_stats, label_components
+
+EARTH_RADIUS_KM = 6371.0
+OBJECT_COLUMNS = ["step", "time", "label", "size", "lon", "lat", "orientation",
+                  "west", "east", "south", "north"]
+TRACK_MIN_SIZE = 5  # smallest CAB/KD object (grid cells) that is tracked
+TRACK_MAX_KM = 500.0  # furthest an object's centroid may move in a day and keep its track
+
+
+def lonlat_boxes(labels, n, lon2, lat2):
+    """
+    West, east, south and north edges (degrees) of the cells of each component
+    1..n of a 2D label array (entry 0 is NaN). A cell reaches half a grid step
+    either side of its centre.
+    """
+    half_x = np.abs(np.gradient(lon2, axis=1))/2 if lon2.shape[1] > 1 else np.zeros(lon2.shape)
+    half_y = np.abs(np.gradient(lat2, axis=0))/2 if lat2.shape[0] > 1 else np.zeros(lat2.shape)
+    points = np.flatnonzero(labels)
+    lab = labels.ravel()[points]
+    boxes = []
+    for values, reduce, start in ((lon2 - half_x, np.minimum, np.inf), (lon2 + half_x, np.maximum, -np.inf),
+                                  (lat2 - half_y, np.minimum, np.inf), (lat2 + half_y, np.maximum, -np.inf)):
+        edge = np.full(n + 1, start)
+        reduce.at(edge, lab, values.ravel()[points])
+        edge[0] = np.nan
+        boxes.append(edge)
+    return boxes
+
+
+def extract_objects(edges, lon=None, lat=None, times=None, min_size=1):
+    """
+    One row per edge object of every slice.
+    Parameters
+    ----------
+    edges : EdgePoints, or edge mask (time, lat, lon)
+       detected edges; an EdgePoints is expanded one slice at a time
+    lon, lat : 1D or 2D arrays
+       grid coordinates (taken from ``edges`` if it is an EdgePoints)
+    times : sequence or None
+       time of each slice (e.g. datetimes); slice indices if None
+    min_size : int
+       smallest object (grid cells) to keep
+    Returns
+    -------
+    DataFrame with OBJECT_COLUMNS: slice index, time, label within the slice,
+    size, centroid lon/lat, orientation (radians) and lon/lat bounding box
+    """
+    dense = not hasattr(edges, "to_dense")
+    if not dense:
+        lon, lat = edges.lon, edges.lat
+    lon2, lat2 = np.meshgrid(lon, lat) if np.ndim(lon) == 1 else (lon, lat)
+    times = range(len(edges)) if times is None else times
+    frames = []
+    for k, time in enumerate(times):
+        mask = edges[k] if dense else edges.to_dense(k)
+        labels, n = label_components(mask)
+        stats = component_stats(labels, n, lon2, lat2)
+        west, east, south, north = lonlat_boxes(labels, n, lon2, lat2)
+        keep = np.flatnonzero(stats["size"] >= max(min_size, 1))
+        frame = pd.DataFrame({"step": k, "time": [time]*len(keep), "label": keep,
+                              "size": stats["size"][keep], "lon": stats["mean_lon"][keep],
+                              "lat": stats["mean_lat"][keep], "orientation": stats["orientation"][keep],
+                              "west": west[keep], "east": east[keep], "south": south[keep], "north": north[keep]})
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=OBJECT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _xyz(lon, lat):
+    """Points on a sphere of radius EARTH_RADIUS_KM; chord lengths approximate distances in km."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    return EARTH_RADIUS_KM*np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+def distance_km(lon1, lat1, lon2, lat2):
+    """Great-circle distance between points."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _box_overlap(prev, curr, i, j, margin):
+    """
+    Intersection over union of the lon/lat bounding boxes of prev[i] and
+    curr[j], each grown by ``margin`` degrees; 0 where a box is missing.
+    """
+    def box(objects, idx):
+        return [objects[col].to_numpy(float)[idx] + grow for col, grow in
+                (("south", -margin), ("north", margin), ("west", -margin), ("east", margin))]
+    y0a, y1a, x0a, x1a = box(prev, i)
+    y0b, y1b, x0b, x1b = box(curr, j)
+    inter = (np.clip(np.minimum(y1a, y1b) - np.maximum(y0a, y0b), 0, None)
+             * np.clip(np.minimum(x1a, x1b) - np.maximum(x0a, x0b), 0, None))
+    union = (y1a - y0a)*(x1a - x0a) + (y1b - y0b)*(x1b - x0b) - inter
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nan_to_num(inter/union, nan=0.0)
+
+
+def match_objects(prev, curr, max_distance_km=500.0, margin=0.5):
+    """
+    Link objects of one time (``prev``) to those of the next (``curr``), as
+    returned by ``extract_objects``. Candidates are the pairs with centroids
+    within ``max_distance_km``; they are scored by the overlap of their bounding
+    boxes grown by ``margin`` degrees (then by distance) and accepted best
+    first, each object used at most once.
+    Returns matched positional indices (i into prev, j into curr).
+    """
+    if len(prev) == 0 or len(curr) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    xyz_prev = _xyz(prev["lon"].to_numpy(), prev["lat"].to_numpy())
+    xyz_curr = _xyz(curr["lon"].to_numpy(), curr["lat"].to_numpy())
+    pairs = cKDTree(xyz_prev).sparse_distance_matrix(cKDTree(xyz_curr), max_distance_km,
+                                                     output_type="ndarray")
+    if len(pairs) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    i, j, dist = pairs["i"], pairs["j"], pairs["v"]
+    score = _box_overlap(prev, curr, i, j, margin)
+    order = np.lexsort((dist, -score))
+    used_prev = np.zeros(len(prev), bool)
+    used_curr = np.zeros(len(curr), bool)
+    keep = []
+    for p in order:
+        if not used_prev[i[p]] and not used_curr[j[p]]:
+            used_prev[i[p]] = used_curr[j[p]] = True
+            keep.append(p)
+    keep = np.asarray(keep, int)
+    return i[keep], j[keep]
+
+
+def continue_tracks(prev, curr, next_id, max_distance_km=500.0, margin=0.5):
+    """
+    Track IDs for ``curr``: those of the ``prev`` objects they match (``prev``
+    needs a "track" column), new IDs from ``next_id`` upwards for the rest.
+    Returns (track IDs, next unused ID).
+    """
+    track = np.full(len(curr), -1, np.int64)
+    i, j = match_objects(prev, curr, max_distance_km, margin)
+    track[j] = prev["track"].to_numpy()[i]
+    new = np.flatnonzero(track < 0)
+    track[new] = next_id + np.arange(len(new))
+    return track, next_id + len(new)
+
+
+def track_objects(objects, max_distance_km=500.0, margin=0.5, by=None):
+    """
+    Add a "track" ID column to ``objects`` (from ``extract_objects``), linking
+    consecutive steps. ``by`` names columns that separate independent series,
+    e.g. "member" for an ensemble forecast tracked along its leads; track IDs
+    are unique across all of them. Also adds "speed", the distance moved since
+    the track's previous object divided by the time step (km per unit of
+    "time", km/h for datetimes), NaN for a track's first object.
+    """
+    objects = objects.sort_values((by if isinstance(by, list) else [by] if by else []) + ["step"],
+                                  kind="stable").reset_index(drop=True)
+    objects["track"] = -1
+    next_id = 0
+    groups = objects.groupby(by, sort=False) if by else [(None, objects)]
+    for _, group in groups:
+        prev = None
+        for _, curr in group.groupby("step", sort=True):
+            if prev is None:
+                track = next_id + np.arange(len(curr))
+                next_id += len(curr)
+            else:
+                track, next_id = continue_tracks(prev, curr, next_id, max_distance_km, margin)
+            objects.loc[curr.index, "track"] = track
+            prev = objects.loc[curr.index]
+    return _add_speed(objects)
+
+
+def _elapsed(time):
+    """Time differences in hours for datetimes, as plain numbers otherwise."""
+    if np.issubdtype(time.dtype, np.datetime64):
+        return time.diff().dt.total_seconds()/3600.0
+    return time.astype(float).diff()
+
+
+def _add_speed(objects):
+    """Speed of each object since the previous object of its track."""
+    objects = objects.sort_values(["track", "step"], kind="stable")
+    same = objects["track"].eq(objects["track"].shift())
+    lon, lat = objects["lon"].to_numpy(float), objects["lat"].to_numpy(float)
+    moved = distance_km(objects["lon"].shift().to_numpy(float), objects["lat"].shift().to_numpy(float),
+                        lon, lat)
+    time = objects["time"]
+    if not np.issubdtype(time.dtype, np.datetime64) and time.dtype == object:
+        time = pd.to_datetime(time)
+    objects["speed"] = np.divide(moved, _elapsed(time).to_numpy(), out=np.full(len(objects), np.nan),
+                                 where=same.to_numpy())
+    return objects.sort_index()
+
+
+def append_step(history, curr, max_distance_km=500.0, margin=0.5, next_id=None):
+    """
+    Track the objects ``curr`` of a new time onwards from ``history`` (earlier
+    ``track_objects``/``append_step`` output, possibly empty), continuing the
+    tracks of its last step; for daily runs that keep their tracks on disk.
+    New tracks are numbered from ``next_id`` (default: one more than history's
+    largest). Returns ``curr`` with "track" and "speed" columns.
+    """
+    curr = curr.copy()
+    if next_id is None:
+        next_id = int(history["track"].max()) + 1 if len(history) else 0
+    if len(history):
+        last = history[history["step"] == history["step"].max()]
+        curr["track"], _ = continue_tracks(last, curr, next_id, max_distance_km, margin)
+    else:
+        last = history.iloc[:0]
+        curr["track"] = next_id + np.arange(len(curr))
+    both = _add_speed(pd.concat([last, curr], ignore_index=True))
+    curr["speed"] = both["speed"].to_numpy()[len(last):]
+    return curr
+
+
+def track_summary(objects, by=None):
+    """
+    One row per track of ``track_objects`` output: first and last time, number
+    of steps, lifetime (last minus first time), mean length, mean speed and
+    net displacement (km) between the first and last centroids. The ``by``
+    columns the tracks were separated by lead the row.
+    """
+    grouped = objects.sort_values("step", kind="stable").groupby("track", sort=True)
+    first, last = grouped.first(), grouped.last()
+    summary = pd.DataFrame({
+        **{name: first[name] for name in (by if isinstance(by, list) else [by] if by else [])},
+        "start": first["time"], "end": last["time"], "steps": grouped.size(),
+        "lifetime": last["time"] - first["time"], "mean_size": grouped["size"].mean(),
+        "mean_speed": grouped["speed"].mean(),
+        "displacement_km": distance_km(first["lon"], first["lat"], last["lon"], last["lat"]),
+    })
+    return summary